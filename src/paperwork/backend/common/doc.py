@@ -21,8 +21,9 @@ import os
 import os.path
 import time
 
-from paperwork.backend.common.page import BasicPage
-from paperwork.backend.labels import Label
+from paperwork.backend.common.page import redo_pages_ocr
+from paperwork.backend.common.thumbnails import get_thumbnail_cache
+from paperwork.backend.labels import LABEL_TABLE
 from paperwork.util import dummy_progress_cb
 
 
@@ -44,21 +45,33 @@ class BasicDoc(object):
         else:
             self.docid = docid
             self.path = docpath
+        # labels of the document, loaded from the label file on first access
+        self.__labels = None
 
     def __str__(self):
         return self.docid
 
-    def redo_ocr(self, ocrlang, callback=dummy_progress_cb):
+    def drop_cache(self):
         """
-        Run the OCR again on all the pages of the document
+        Forget everything cached about the document content. Must be called
+        each time files of the document are added or removed.
+        """
+        pass
 
-        Arguments
+    def redo_ocr(self, ocrlang, callback=dummy_progress_cb, can_run_cb=None):
+        """
+        Run the OCR again on all the pages of the document. The pages are
+        OCR'd in parallel.
+
+        Arguments:
+            ocrlang --- lang to specify to the OCR tool
+            callback --- see util.dummy_progress_cb for a prototype. Called
+                each time a page is done
+            can_run_cb --- see page.redo_pages_ocr()
         """
         nb_pages = self.nb_pages
-        for i in range(0, nb_pages):
-            callback(i, nb_pages, BasicPage.SCAN_STEP_OCR, self)
-            page = self.pages[i]
-            page.redo_ocr(ocrlang)
+        pages = (self.pages[i] for i in xrange(0, nb_pages))
+        redo_pages_ocr(pages, nb_pages, ocrlang, callback, can_run_cb)
 
     def print_page_cb(self, print_op, print_context, page_nb):
         raise NotImplementedError()
@@ -88,52 +101,86 @@ class BasicDoc(object):
                 print "Deleting dir %s" % dirpath
                 os.rmdir(dirpath)
         os.rmdir(self.path)
+        self.drop_cache()
+        get_thumbnail_cache().remove(self.path)
         print "Done"
 
     def add_label(self, label):
         """
         Add a label on the document.
         """
-        if label in self.labels:
+        labels = self.__load_labels()
+        if label in labels:
             return
         with codecs.open(os.path.join(self.path, self.LABEL_FILE), 'a',
                         encoding='utf-8') as file_desc:
             file_desc.write("%s,%s\n" % (label.name, label.get_color_str()))
+        labels.append(LABEL_TABLE.get_label(label.name,
+                                            label.get_color_str()))
 
     def remove_label(self, to_remove):
         """
         Remove a label from the document. (-> rewrite the label file)
         """
-        if not to_remove in self.labels:
+        labels = self.__load_labels()
+        if not to_remove in labels:
             return
-        labels = self.labels
         labels.remove(to_remove)
-        with codecs.open(os.path.join(self.path, self.LABEL_FILE), 'w',
-                        encoding='utf-8') as file_desc:
-            for label in labels:
-                file_desc.write("%s,%s\n" % (label.name,
-                                             label.get_color_str()))
+        self.__save_labels()
 
-    def __get_labels(self):
+    def __load_labels(self):
         """
-        Read the label file of the documents and extract all the labels
+        Read the label file of the documents and extract all the labels.
+        The file is read only once: the labels are then kept in memory, and
+        add_label(), remove_label() and update_label() keep both in sync.
 
         Returns:
-            An array of labels.Label objects
+            The (mutable) list of labels.Label objects of the document
         """
+        if self.__labels is not None:
+            return self.__labels
         labels = []
         try:
             with codecs.open(os.path.join(self.path, self.LABEL_FILE), 'r',
                              encoding='utf-8') as file_desc:
                 for line in file_desc.readlines():
-                    line = line.strip()
-                    (label_name, label_color) = line.split(",")
-                    labels.append(Label(name=label_name, color=label_color))
+                    labels.append(LABEL_TABLE.parse_line(line))
         except IOError:
             pass
+        self.__labels = labels
         return labels
 
-    labels = property(__get_labels)
+    def __save_labels(self):
+        """
+        Rewrite the label file of the document. The new file is written
+        aside and then renamed, so the label file is never left half written.
+        """
+        filepath = os.path.join(self.path, self.LABEL_FILE)
+        tmp_filepath = filepath + ".tmp"
+        with codecs.open(tmp_filepath, 'w', encoding='utf-8') as file_desc:
+            for label in self.__labels:
+                file_desc.write("%s,%s\n" % (label.name,
+                                             label.get_color_str()))
+        os.rename(tmp_filepath, filepath)
+
+    def __get_labels(self):
+        """
+        Returns:
+            An array of labels.Label objects
+        """
+        return list(self.__load_labels())
+
+    def __set_labels(self, labels):
+        """
+        Set the labels already known for this document (for instance from an
+        index), so the label file doesn't have to be read again. Doesn't
+        modify the label file.
+        """
+        self.__labels = [LABEL_TABLE.get_label(label.name,
+                                               label.get_color_str())
+                         for label in labels]
+
+    labels = property(__get_labels, __set_labels)
 
     def update_label(self, old_label, new_label):
         """
@@ -143,18 +190,17 @@ class BasicDoc(object):
         """
         print ("%s : Updating label ([%s] -> [%s])"
                % (str(self), str(old_label), str(new_label)))
-        labels = self.labels
+        labels = self.__load_labels()
         try:
             labels.remove(old_label)
         except ValueError:
             # this document doesn't have this label
             return
-        labels.append(new_label)
-        with codecs.open(os.path.join(self.path, self.LABEL_FILE), 'w',
-                        encoding='utf-8') as file_desc:
-            for label in labels:
-                file_desc.write("%s,%s\n" % (label.name,
-                                             label.get_color_str()))
+        new_label = LABEL_TABLE.get_label(new_label.name,
+                                          new_label.get_color_str())
+        if not new_label in labels:
+            labels.append(new_label)
+        self.__save_labels()
 
     @staticmethod
     def get_export_formats():
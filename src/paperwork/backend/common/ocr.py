@@ -0,0 +1,335 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+OCR service shared by the scan, the import and the OCR redoing: a pool of
+worker processes, started once and kept until Paperwork exits.
+"""
+
+import multiprocessing
+import os
+import Queue
+import re
+import signal
+import threading
+import time
+import traceback
+
+import Image
+import pyocr.builders
+import pyocr.pyocr
+
+from paperwork.util import check_spelling
+
+
+def _compute_ocr_score_without_spell_checking(ocr_lang, txt):
+    """
+    Try to evaluate how well the OCR worked.
+    Current implementation:
+        The score is the number of words only made of 4 or more letters
+        ([a-zA-Z])
+    """
+    # TODO(Jflesch): i18n / l10n
+    score = 0
+    prog = re.compile(r'^[a-zA-Z]{4,}$')
+    for word in txt.split(" "):
+        if prog.match(word):
+            score += 1
+    return (txt, score)
+
+
+def _compute_ocr_score(ocr_lang, txt):
+    """
+    Evaluate how well the OCR worked, with the best method available
+
+    Returns:
+        The score of the text. The higher the better.
+    """
+    SCORE_METHODS = [
+        ("spell_checker", check_spelling),
+        ("lucky_guess", _compute_ocr_score_without_spell_checking),
+        ("no_score", lambda ocr_lang, txt: (txt, 0))
+    ]
+
+    for score_method in SCORE_METHODS:
+        try:
+            (fixed_text, score) = score_method[1](ocr_lang, txt)
+            # TODO(Jflesch): For now, we throw away the fixed version:
+            # The original version may contain proper nouns, and spell
+            # checking could make them disappear
+            # However, it would be best if we could keep both versions
+            # without increasing too much indexation time
+            return score
+        except Exception, exc:
+            print ("**WARNING** Scoring method '%s' failed !"
+                   % score_method[0])
+            print ("Reason: %s" % (str(exc)))
+    return 0
+
+
+def _boxes_to_text(boxes):
+    """
+    Rebuild the text of a page from its word boxes: the words come in the
+    reading order, and a word starting on the left of the previous one
+    starts a new line.
+    """
+    lines = []
+    line = []
+    last_x = None
+    for box in boxes:
+        x = box.position[0][0]
+        if last_x is not None and x <= last_x:
+            lines.append(u" ".join(line))
+            line = []
+        line.append(box.content)
+        last_x = x
+    if len(line) > 0:
+        lines.append(u" ".join(line))
+    return u"\n".join(lines)
+
+
+# OCR tool of the current worker process. Looked for only once per process
+_WORKER_OCR_TOOL = None
+# See OcrPool.__init__()
+_WORKER_JOBS = None
+
+
+def _init_worker(jobs_lock, running_pids, cancelled):
+    """
+    Run once in each worker process, when it starts
+    """
+    global _WORKER_OCR_TOOL
+    global _WORKER_JOBS
+    # the OCR tool runs in its own process. This way, it belongs to the
+    # process group of the worker, and both can be killed at once when the
+    # job is cancelled (see OcrPool.__cancel())
+    os.setsid()
+    _WORKER_JOBS = (jobs_lock, running_pids, cancelled)
+    ocr_tools = pyocr.pyocr.get_available_tools()
+    if len(ocr_tools) > 0:
+        _WORKER_OCR_TOOL = ocr_tools[0]
+
+
+def _run_job(job):
+    """
+    Run in the worker processes: OCR an image. The word boxes and the text
+    come from the same OCR run.
+
+    Arguments:
+        job --- tuple (job id, job slot, OCR lang, compute the score
+            (boolean), (image mode, image size, raw image data))
+
+    Returns:
+        A tuple (job id, (score, text, boxes), None), or (job id, None,
+        error message) if the OCR failed or if the job was cancelled
+    """
+    (job_id, slot, ocr_lang, with_score, (mode, size, data)) = job
+    (jobs_lock, running_pids, cancelled) = _WORKER_JOBS
+    with jobs_lock:
+        if cancelled[slot]:
+            return (job_id, None, "cancelled")
+        running_pids[slot] = os.getpid()
+    try:
+        if _WORKER_OCR_TOOL is None:
+            raise Exception("No OCR tool available")
+        img = Image.fromstring(mode, size, data)
+        boxes = _WORKER_OCR_TOOL.image_to_string(
+            img, lang=ocr_lang, builder=pyocr.builders.WordBoxBuilder())
+        text = _boxes_to_text(boxes)
+        score = 0
+        if with_score:
+            score = _compute_ocr_score(ocr_lang, text)
+        return (job_id, (score, text, boxes), None)
+    except Exception, exc:
+        traceback.print_exc()
+        return (job_id, None, str(exc))
+    finally:
+        # from now on, the worker can't be killed anymore by a cancellation
+        with jobs_lock:
+            running_pids[slot] = 0
+
+
+class OcrPool(object):
+    """
+    Pool of processes running the OCR. Images are sent to them in memory,
+    and each OCR run returns both the text and the word boxes.
+
+    Thread-safe: several threads can submit images at the same time.
+    """
+
+    # Maximum number of jobs sent to the workers and not done at a given
+    # time, all the callers included
+    MAX_JOBS = 1024
+    # A job not done after this time (in seconds) is considered as failed:
+    # a worker that dies takes its job with it
+    JOB_TIMEOUT = 300
+
+    def __init__(self, nb_processes=None):
+        if nb_processes is None:
+            nb_processes = multiprocessing.cpu_count()
+        self.nb_processes = nb_processes
+        self.__job_id_lock = threading.Lock()
+        self.__next_job_id = 0
+        # shared with the workers, indexed by job slot (job id % MAX_JOBS):
+        # - the PID of the worker running the job (0 if none)
+        # - whether the job has been cancelled
+        # Workers are only killed while holding the lock, so a worker can't
+        # be killed while taking it, or once it's done with its job
+        self.__jobs_lock = multiprocessing.Lock()
+        self.__running_pids = multiprocessing.RawArray('i', self.MAX_JOBS)
+        self.__cancelled = multiprocessing.RawArray('b', self.MAX_JOBS)
+        self.__pool = multiprocessing.Pool(
+            nb_processes, initializer=_init_worker,
+            initargs=(self.__jobs_lock, self.__running_pids,
+                      self.__cancelled))
+
+    def __new_job(self):
+        """
+        Returns:
+            A tuple (job id, job slot)
+        """
+        with self.__job_id_lock:
+            job_id = self.__next_job_id
+            self.__next_job_id += 1
+        slot = job_id % self.MAX_JOBS
+        with self.__jobs_lock:
+            self.__cancelled[slot] = 0
+        return (job_id, slot)
+
+    def __cancel(self, job_ids):
+        """
+        Cancel jobs: the ones not started yet won't be, and the workers
+        running the other ones are killed along with their OCR tool. The
+        pool then starts new workers to replace them.
+        """
+        with self.__jobs_lock:
+            for job_id in job_ids:
+                slot = job_id % self.MAX_JOBS
+                self.__cancelled[slot] = 1
+                pid = self.__running_pids[slot]
+                if pid == 0:
+                    continue
+                print "Killing OCR worker %d" % pid
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError, exc:
+                    print "Warning: Unable to kill OCR worker: %s" % str(exc)
+                self.__running_pids[slot] = 0
+
+    def run(self, jobs, ocr_lang, with_score=False, max_pending=None):
+        """
+        OCR a set of images. Only a few images are sent at once to the
+        workers, so the caller can stop iterating as soon as it has what it
+        wants: the images not sent yet are then dropped, and the OCR of
+        the ones already sent is cancelled.
+
+        Arguments:
+            jobs --- iterable of tuples (key, PIL image)
+            ocr_lang --- lang to specify to the OCR tool
+            with_score --- if True, evaluate how well the OCR worked (see
+                util.check_spelling())
+            max_pending --- maximum number of images sent to the workers
+                and not handled yet. Default: the number of workers
+
+        Returns:
+            A generator of tuples (key, score, text, boxes), in the order
+            the OCR runs end. Score is 0 if with_score is False. Images on
+            which the OCR failed, or took more than JOB_TIMEOUT, are
+            skipped.
+        """
+        if max_pending is None:
+            max_pending = self.nb_processes
+        results = Queue.Queue()
+        # job id -> (key, deadline, AsyncResult)
+        pending = {}
+        jobs = iter(jobs)
+        try:
+            while True:
+                while len(pending) < max_pending:
+                    try:
+                        (key, img) = jobs.next()
+                    except StopIteration:
+                        break
+                    (job_id, slot) = self.__new_job()
+                    async_result = self.__pool.apply_async(
+                        _run_job, [(job_id, slot, ocr_lang, with_score,
+                                    (img.mode, img.size, img.tostring()))],
+                        callback=results.put)
+                    pending[job_id] = (key, time.time() + self.JOB_TIMEOUT,
+                                       async_result)
+                if len(pending) <= 0:
+                    return
+                deadline = min([job[1] for job in pending.values()])
+                try:
+                    (done_id, result, error) = results.get(
+                        timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    self.__drop_timed_out_jobs(pending)
+                    continue
+                if not done_id in pending:
+                    # already considered as timed out
+                    continue
+                key = pending.pop(done_id)[0]
+                if error is not None:
+                    print "Warning: OCR failed on %s: %s" % (str(key), error)
+                    continue
+                (score, text, boxes) = result
+                yield (key, score, text, boxes)
+        finally:
+            # the caller doesn't want the remaining results
+            if len(pending) > 0:
+                self.__cancel(pending.keys())
+
+    def __drop_timed_out_jobs(self, pending):
+        """
+        Cancel and forget the jobs of run() that should be done by now
+        """
+        now = time.time()
+        for (job_id, (key, deadline, async_result)) in pending.items():
+            # if the job is done, its result is already waiting in the queue
+            if deadline > now or async_result.ready():
+                continue
+            print "Warning: OCR of %s timed out" % str(key)
+            self.__cancel([job_id])
+            pending.pop(job_id)
+
+    def ocr(self, img, ocr_lang, with_score=False):
+        """
+        OCR one image
+
+        Returns:
+            A tuple (score, text, boxes). See run().
+        """
+        for (_, score, text, boxes) in self.run([(None, img)], ocr_lang,
+                                                with_score):
+            return (score, text, boxes)
+        raise Exception("OCR failed")
+
+
+__OCR_POOL = None
+__OCR_POOL_LOCK = threading.Lock()
+
+
+def get_ocr_pool():
+    """
+    Returns the OCR pool (see OcrPool). It's started the first time it is
+    needed, and then kept until Paperwork exits.
+    """
+    global __OCR_POOL
+    with __OCR_POOL_LOCK:
+        if __OCR_POOL is None:
+            __OCR_POOL = OcrPool()
+        return __OCR_POOL
@@ -14,13 +14,22 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import codecs
 from copy import copy
 import Image
+import math
 import os
 import os.path
 import re
 
+import pyocr.pyocr
+
+from paperwork.backend.common.ocr import get_ocr_pool
+from paperwork.backend.common.thumbnails import get_thumbnail_cache
+from paperwork.util import dummy_progress_cb
+from paperwork.util import LRUCache
+from paperwork.util import split_text
 from paperwork.util import split_words
 
 
@@ -49,10 +58,10 @@ class PageExporter(object):
         # We also adjust the size of the image
         resize_factor = float(self.__quality) / 100.0
 
-        img = self.page.img
-
-        new_size = (int(resize_factor * img.size[0]),
-                    int(resize_factor * img.size[1]))
+        (width, height) = self.page.get_image_size()
+        new_size = (int(resize_factor * width),
+                    int(resize_factor * height))
+        img = self.page.get_image(new_size[0])
         img = img.resize(new_size, Image.ANTIALIAS)
 
         img.save(target_path, self.img_format, quality=quality)
@@ -97,6 +106,13 @@ class BasicPage(object):
     boxes = []
     img = None
 
+    # (see _get_boxes_cache_key()) -> (sorted keywords, keyword -> boxes)
+    # Shared by all the pages: page objects are short-lived
+    __box_maps = LRUCache(32)
+    # ((see _get_image_cache_key()), width) -> page image decoded at this
+    # width (see get_image()). Used to render the tiles (see get_tile())
+    __tile_sources = LRUCache(2)
+
     def __init__(self, doc, page_nb):
         """
         Don't create directly. Please use ImgDoc.get_page()
@@ -109,21 +125,157 @@ class BasicPage(object):
             'JPEG' : PageExporter(self, 'JPEG', 'image/jpeg', ["jpeg", "jpg"]),
         }
 
-    def get_thumbnail(self, width):
+    def get_image(self, max_width=None):
+        """
+        Returns the image of the page (PIL image), possibly at a lower
+        resolution if the caller doesn't need more than 'max_width' pixels
+        wide. The image is still at least 'max_width' wide (unless the full
+        resolution image is smaller), so the caller must resize it.
+
+        Arguments:
+            max_width --- width needed by the caller. None for the full
+                resolution image (same as BasicPage.img)
+        """
+        return self.img
+
+    def get_image_size(self):
+        """
+        Returns the size of the full resolution image of the page, without
+        decoding it if possible.
+        """
+        return self.img.size
+
+    def _get_image_cache_key(self):
+        """
+        Returns a value identifying the current version of the page image
+        (for instance, its path and modification time). None if it must not
+        be cached.
+        """
+        return None
+
+    def __get_tile_source(self, width):
+        """
+        Returns the page image decoded at (at least) the given width
+        """
+        cache_key = self._get_image_cache_key()
+        if cache_key is not None:
+            cache_key = (cache_key, width)
+            img = self.__tile_sources.get(cache_key)
+            if img is not None:
+                return img
+        img = self.get_image(width)
+        img.load()
+        if cache_key is not None:
+            self.__tile_sources.put(cache_key, img)
+        return img
+
+    def get_tile(self, factor, area):
+        """
+        Render a part of the page image at the given zoom level. The page
+        image is decoded only once for all the tiles of a zoom level.
+
+        Arguments:
+            factor --- zoom factor (relative to get_image_size())
+            area --- (x, y, width, height): part of the zoomed image to
+                render
+
+        Returns:
+            A PIL image of size (width, height)
+        """
+        (img_width, img_height) = self.get_image_size()
+        img = self.__get_tile_source(int(math.ceil(factor * img_width)))
+        ratio = float(img.size[0]) / (factor * img_width)
+        (x, y, width, height) = area
+        box = (int(x * ratio), int(y * ratio),
+               min(img.size[0], int(math.ceil((x + width) * ratio))),
+               min(img.size[1], int(math.ceil((y + height) * ratio))))
+        return img.crop(box).resize((width, height), Image.BILINEAR)
+
+    def _make_thumbnail(self, width):
+        """
+        Returns:
+            A new thumbnail of the page (PIL image) of the given width
+        """
         raise NotImplementedError()
 
+    def _get_thumbnail_source_mtime(self):
+        """
+        Returns the modification time of the file the thumbnail is made from.
+        None if the thumbnail must not be cached.
+        """
+        return None
+
+    def get_thumbnail(self, width):
+        """
+        Returns a thumbnail of the page (PIL image). Thumbnails are
+        kept in the thumbnail cache (see thumbnails.ThumbnailCache) until
+        their source file is modified.
+        """
+        mtime = self._get_thumbnail_source_mtime()
+        if mtime is None:
+            return self._make_thumbnail(width)
+        cache = get_thumbnail_cache()
+        img = cache.get(self.doc.path, self.page_nb, width, mtime)
+        if img is None:
+            img = self._make_thumbnail(width)
+            cache.put(self.doc.path, self.page_nb, width, mtime, img)
+        return img
+
     def print_page_cb(self, print_op, print_context):
         raise NotImplementedError()
 
     def redo_ocr(self, ocrlang):
         raise NotImplementedError()
 
+    def _save_ocr_result(self, txt, boxes):
+        """
+        Replace the text and the word boxes of the page by the given ones
+        (see redo_pages_ocr())
+        """
+        raise NotImplementedError()
+
     def destroy(self):
         raise NotImplementedError()
 
+    def _get_boxes_cache_key(self):
+        """
+        Returns a value identifying the current version of the word boxes of
+        this page (for instance, the path and the modification time of the
+        file they are stored in). None if they must not be cached.
+        """
+        return None
+
+    def __get_box_map(self):
+        """
+        Index the word boxes of the page by keyword.
+
+        Returns:
+            (sorted keywords, dict keyword -> array of boxes)
+        """
+        cache_key = self._get_boxes_cache_key()
+        if cache_key is not None:
+            box_map = self.__box_maps.get(cache_key)
+            if box_map is not None:
+                return box_map
+
+        keyword_to_boxes = {}
+        for box in self.boxes:
+            for word in set(split_words(box.content)):
+                if word in keyword_to_boxes:
+                    keyword_to_boxes[word].append(box)
+                else:
+                    keyword_to_boxes[word] = [box]
+        box_map = (sorted(keyword_to_boxes.keys()), keyword_to_boxes)
+
+        if cache_key is not None:
+            self.__box_maps.put(cache_key, box_map)
+        return box_map
+
     def get_boxes(self, sentence):
         """
-        Get all the boxes corresponding the given sentence
+        Get all the boxes corresponding the given sentence. Boxes containing
+        words starting with the keywords are included (like the suggestions
+        of DocSearch).
 
         Arguments:
             sentence --- can be string (will be splited), or an array of strings
@@ -136,13 +288,19 @@ class BasicPage(object):
             assert(isinstance(sentence, list))
             keywords = sentence
 
+        (sorted_keywords, keyword_to_boxes) = self.__get_box_map()
+
         output = []
+        already_in = set()
         for keyword in keywords:
-            for box in self.boxes:
-                # unfold generator output
-                words = [x for x in split_words(box.content)]
-                if keyword in words:
-                    output.append(box)
+            idx = bisect.bisect_left(sorted_keywords, keyword)
+            while (idx < len(sorted_keywords)
+                   and sorted_keywords[idx].startswith(keyword)):
+                for box in keyword_to_boxes[sorted_keywords[idx]]:
+                    if not id(box) in already_in:
+                        already_in.add(id(box))
+                        output.append(box)
+                idx += 1
         return output
 
     def get_export_formats(self):
@@ -169,9 +327,8 @@ class BasicPage(object):
         Returns:
             An array of strings
         """
-        for line in self.text:
-            for word in split_words(line):
-                yield(word)
+        for word in split_text(self.text):
+            yield(word)
 
     keywords = property(__get_keywords)
 
@@ -189,6 +346,9 @@ class DummyPage(object):
     def get_thumbnail(self, width):
         raise NotImplementedError()
 
+    def get_image(self, max_width=None):
+        return None
+
     def print_page_cb(self, print_op, print_context):
         raise NotImplementedError()
 
@@ -209,3 +369,61 @@ class DummyPage(object):
 
     def __str__(self):
         return "Dummy page"
+
+
+def _load_page_images(pages):
+    """
+    Load the images of the pages, one at a time. Pages whose image can't be
+    loaded are skipped.
+
+    Returns:
+        A generator of tuples (page, PIL image)
+    """
+    for page in pages:
+        try:
+            img = page.img
+            # PIL only decodes the image when its content is first needed
+            img.load()
+        except Exception, exc:
+            print "Warning: Unable to load the image of %s: %s" % (str(page),
+                                                                   str(exc))
+            continue
+        yield (page, img)
+
+
+def redo_pages_ocr(pages, nb_pages, ocrlang, callback=dummy_progress_cb,
+                   can_run_cb=None):
+    """
+    Run the OCR again on a set of pages. The pages are OCR'd in parallel
+    in the OCR pool (see ocr.OcrPool): each worker takes the next page as
+    soon as it's done with the previous one. Only a few page images are
+    loaded at a time. Pages that can't be loaded or OCR'd are skipped.
+
+    Arguments:
+        pages --- iterable of pages, in the order they must be OCR'd.
+            Consumed only as the OCR goes on
+        nb_pages --- number of pages in 'pages' (only for the progression)
+        ocrlang --- lang to specify to the OCR tool
+        callback --- called each time a page is done. See
+            util.dummy_progress_cb for a prototype. The step is always
+            BasicPage.SCAN_STEP_OCR
+        can_run_cb --- called each time a page is done. If it returns False,
+            the OCR is stopped: pages not done yet are left untouched
+
+    Returns:
+        The number of pages done
+    """
+    ocr_tools = pyocr.pyocr.get_available_tools()
+    if len(ocr_tools) <= 0:
+        raise Exception("No OCR tool available")
+
+    jobs = _load_page_images(pages)
+    nb_done = 0
+    for (page, _, txt, boxes) in get_ocr_pool().run(jobs, ocrlang):
+        page._save_ocr_result(txt, boxes)
+        nb_done += 1
+        callback(nb_done, nb_pages, BasicPage.SCAN_STEP_OCR, page.doc)
+        if can_run_cb is not None and not can_run_cb():
+            print "OCR interrupted"
+            break
+    return nb_done
@@ -0,0 +1,208 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Persistent cache of the page thumbnails, shared by all the documents
+"""
+
+import os
+import os.path
+import sqlite3
+import StringIO
+import threading
+import time
+
+import Image
+
+
+class ThumbnailCache(object):
+    """
+    Stores the thumbnails of the pages in a single SQLite database.
+    Thumbnails are identified by (document path, page number, width) and
+    are only valid for a given modification time of their source. When the
+    cache is full, the least recently used thumbnails are dropped. The
+    access times are kept in memory and written in batches.
+
+    Each thread gets its own connection to the database.
+    """
+
+    # Maximum number of thumbnails kept
+    MAX_THUMBNAILS = 20000
+    # Dropped at once when the cache is full, so we don't have to evict on
+    # each new thumbnail
+    EVICTION_BATCH = 500
+    # Number of cache hits after which their access times are written
+    ACCESS_FLUSH_BATCH = 64
+    THUMBNAIL_FORMAT = "JPEG"
+    THUMBNAIL_QUALITY = 90
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__nb_thumbnails = None
+        # (doc path, page number, width) -> time of the last access not
+        # written yet
+        self.__accesses = {}
+
+    def __get_connection(self):
+        """
+        Returns the connection of the current thread to the database
+        """
+        connection = getattr(self.__local, 'connection', None)
+        # a connection must not be shared with a child process (fork)
+        if (connection is not None
+                and self.__local.pid == os.getpid()):
+            return connection
+        db_dir = os.path.dirname(self.db_path)
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        connection = sqlite3.connect(self.db_path, timeout=10)
+        # it's only a cache: losing the last changes on a crash doesn't matter
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE IF NOT EXISTS thumbnails ("
+                           " doc TEXT, page INTEGER, width INTEGER,"
+                           " mtime REAL, last_access REAL, data BLOB,"
+                           " PRIMARY KEY (doc, page, width))")
+        connection.execute("CREATE INDEX IF NOT EXISTS thumbnails_access"
+                           " ON thumbnails (last_access)")
+        connection.commit()
+        self.__local.connection = connection
+        self.__local.pid = os.getpid()
+        return connection
+
+    def get(self, doc_path, page_nb, width, mtime):
+        """
+        Returns:
+            The cached thumbnail (PIL image), or None if there is none or if
+            it is older than 'mtime'
+        """
+        try:
+            connection = self.__get_connection()
+            row = connection.execute(
+                "SELECT mtime, data FROM thumbnails"
+                " WHERE doc = ? AND page = ? AND width = ?",
+                (doc_path, page_nb, width)).fetchone()
+            if row is None or row[0] != mtime:
+                return None
+            with self.__lock:
+                self.__accesses[(doc_path, page_nb, width)] = time.time()
+                must_flush = (len(self.__accesses) >= self.ACCESS_FLUSH_BATCH)
+            if must_flush:
+                self.__flush_accesses(connection)
+        except sqlite3.Error, exc:
+            print "Warning: Unable to read thumbnail cache: %s" % str(exc)
+            return None
+        img = Image.open(StringIO.StringIO(str(row[1])))
+        img.load()
+        return img
+
+    def put(self, doc_path, page_nb, width, mtime, img):
+        """
+        Store a thumbnail in the cache
+
+        Arguments:
+            img --- PIL image
+        """
+        data = StringIO.StringIO()
+        img.convert("RGB").save(data, self.THUMBNAIL_FORMAT,
+                                quality=self.THUMBNAIL_QUALITY)
+        try:
+            connection = self.__get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO thumbnails"
+                " (doc, page, width, mtime, last_access, data)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (doc_path, page_nb, width, mtime, time.time(),
+                 sqlite3.Binary(data.getvalue())))
+            connection.commit()
+            self.__flush_accesses(connection)
+            self.__evict(connection)
+        except sqlite3.Error, exc:
+            print "Warning: Unable to write thumbnail cache: %s" % str(exc)
+
+    def __flush_accesses(self, connection):
+        """
+        Write the access times kept in memory (see get())
+        """
+        with self.__lock:
+            accesses = self.__accesses
+            self.__accesses = {}
+        if len(accesses) <= 0:
+            return
+        connection.executemany(
+            "UPDATE thumbnails SET last_access = ?"
+            " WHERE doc = ? AND page = ? AND width = ?",
+            [(last_access, doc_path, page_nb, width)
+             for ((doc_path, page_nb, width), last_access)
+             in accesses.iteritems()])
+        connection.commit()
+
+    def __evict(self, connection):
+        """
+        Drop the least recently used thumbnails if the cache is full
+        """
+        with self.__lock:
+            if self.__nb_thumbnails is None:
+                self.__nb_thumbnails = connection.execute(
+                    "SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+            else:
+                # may also be a replacement. Counted anyway: it only makes
+                # the eviction (and the real count) happen a bit earlier
+                self.__nb_thumbnails += 1
+            if self.__nb_thumbnails <= self.MAX_THUMBNAILS:
+                return
+            self.__nb_thumbnails = None
+        connection.execute(
+            "DELETE FROM thumbnails WHERE rowid IN ("
+            " SELECT rowid FROM thumbnails ORDER BY last_access LIMIT ?)",
+            (self.EVICTION_BATCH,))
+        connection.commit()
+
+    def remove(self, doc_path, page_nb=None):
+        """
+        Drop the thumbnails of a document or of one of its pages
+        """
+        try:
+            connection = self.__get_connection()
+            if page_nb is None:
+                connection.execute("DELETE FROM thumbnails WHERE doc = ?",
+                                   (doc_path,))
+            else:
+                connection.execute(
+                    "DELETE FROM thumbnails WHERE doc = ? AND page = ?",
+                    (doc_path, page_nb))
+            connection.commit()
+        except sqlite3.Error, exc:
+            print "Warning: Unable to update thumbnail cache: %s" % str(exc)
+
+
+__THUMBNAIL_CACHE = None
+__THUMBNAIL_CACHE_LOCK = threading.Lock()
+
+
+def get_thumbnail_cache():
+    """
+    Returns the thumbnail cache of the current user (see ThumbnailCache)
+    """
+    global __THUMBNAIL_CACHE
+    with __THUMBNAIL_CACHE_LOCK:
+        if __THUMBNAIL_CACHE is None:
+            __THUMBNAIL_CACHE = ThumbnailCache(
+                os.path.join(os.getenv("XDG_CACHE_HOME",
+                                       os.path.expanduser("~/.cache")),
+                             "paperwork", "thumbnails.db"))
+        return __THUMBNAIL_CACHE
@@ -18,14 +18,20 @@
 Contains all the code relative to keyword and document list management list.
 """
 
+import array
+import bisect
+import cPickle
 import multiprocessing
 import os
 import os.path
-import time
+import Queue
+import re
 import threading
 
+from paperwork.backend.common.page import redo_pages_ocr
 from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.img.doc import is_img_doc
+from paperwork.backend.labels import LABEL_TABLE
 from paperwork.backend.pdf.doc import PdfDoc
 from paperwork.backend.pdf.doc import is_pdf_doc
 from paperwork.util import dummy_progress_cb
@@ -38,6 +44,214 @@ DOC_TYPE_LIST = [
     (is_img_doc, ImgDoc)
 ]
 
+# If a posting list is this many times smaller than the other one, the
+# intersection is done by looking up each of its elements in the other one
+# (bisect) instead of using sets
+POSTINGS_BISECT_RATIO = 8
+
+# Search on labels: 'label:taxes', 'label:"income taxes"', '!label:taxes'
+LABEL_QUERY_REGEX = re.compile(r'(!?)label:(?:"([^"]*)"|(\S+))', re.UNICODE)
+
+
+def _get_label_key(label_name):
+    """
+    Returns:
+        The key of a label name in the label index. Searching on labels is
+        case insensitive.
+    """
+    return label_name.strip().lower()
+
+
+def _insert_posting(postings, doc_id):
+    """
+    Add a document id to a posting list (if not already in it)
+    """
+    if len(postings) <= 0 or postings[-1] < doc_id:
+        # most common case: document ids are allocated incrementally
+        postings.append(doc_id)
+        return
+    idx = bisect.bisect_left(postings, doc_id)
+    if idx >= len(postings) or postings[idx] != doc_id:
+        postings.insert(idx, doc_id)
+
+
+def _remove_posting(postings, doc_id):
+    """
+    Remove a document id from a posting list (if in it)
+    """
+    idx = bisect.bisect_left(postings, doc_id)
+    if idx < len(postings) and postings[idx] == doc_id:
+        postings.pop(idx)
+
+
+def _intersect(postings_a, postings_b):
+    """
+    Intersection of two posting lists (sorted arrays of document ids)
+
+    Returns:
+        A new posting list
+    """
+    if len(postings_a) > len(postings_b):
+        (postings_a, postings_b) = (postings_b, postings_a)
+    if len(postings_a) * POSTINGS_BISECT_RATIO >= len(postings_b):
+        return array.array('I',
+                           sorted(set(postings_a).intersection(postings_b)))
+    result = array.array('I')
+    idx = 0
+    end = len(postings_b)
+    for doc_id in postings_a:
+        idx = bisect.bisect_left(postings_b, doc_id, idx, end)
+        if idx >= end:
+            break
+        if postings_b[idx] == doc_id:
+            result.append(doc_id)
+    return result
+
+
+def _difference(postings_a, postings_b):
+    """
+    Documents from the posting list 'postings_a' that are not in 'postings_b'
+
+    Returns:
+        A new posting list
+    """
+    if len(postings_b) <= 0:
+        return array.array('I', postings_a)
+    excluded = set(postings_b)
+    return array.array('I', [doc_id for doc_id in postings_a
+                             if not doc_id in excluded])
+
+
+class _PrefixIndex(object):
+    """
+    Sorted array of keywords, used to look for all the keywords starting with
+    a given prefix.
+
+    New keywords are first put aside and merged in the array the next time
+    it is looked up. Few of them are inserted one by one (bisect) ; Lots of
+    them (indexation) are appended and merged with a single (linear) sort.
+    """
+
+    # Above this number of pending keywords, merge them using sort()
+    MAX_BISECT_INSERTS = 64
+
+    def __init__(self):
+        self.__keywords = []    # array of strings (sorted)
+        self.__pending = set()  # keywords not yet in self.__keywords
+
+    def merge_pending(self):
+        """
+        Put the keywords added since the last lookup in the sorted array
+        """
+        if len(self.__pending) <= 0:
+            return
+        pending = self.__pending
+        self.__pending = set()
+        if len(pending) <= self.MAX_BISECT_INSERTS:
+            for keyword in pending:
+                bisect.insort_left(self.__keywords, keyword)
+            return
+        # Python's sort (Timsort) merges the two sorted runs in linear time
+        self.__keywords.extend(sorted(pending))
+        self.__keywords.sort()
+
+    def add(self, keyword):
+        """
+        Add a keyword. The caller must make sure it's not already in the index
+        """
+        self.__pending.add(keyword)
+
+    def remove(self, keyword):
+        if keyword in self.__pending:
+            self.__pending.remove(keyword)
+            return
+        idx = bisect.bisect_left(self.__keywords, keyword)
+        if idx < len(self.__keywords) and self.__keywords[idx] == keyword:
+            self.__keywords.pop(idx)
+
+    def find(self, prefix):
+        """
+        Returns all the keywords starting with 'prefix', sorted
+        """
+        self.merge_pending()
+        results = []
+        idx = bisect.bisect_left(self.__keywords, prefix)
+        while (idx < len(self.__keywords)
+               and self.__keywords[idx].startswith(prefix)):
+            results.append(self.__keywords[idx])
+            idx += 1
+        return results
+
+    def __len__(self):
+        return len(self.__keywords) + len(self.__pending)
+
+
+def _get_doc_signature(docpath, files=None):
+    """
+    Compute a value that changes each time the keywords or the labels of
+    a document may have changed: the names and modification times of the
+    files they are read from.
+
+    Arguments:
+        files --- content of the document directory. Listed again if None
+    """
+    if files is None:
+        try:
+            files = os.listdir(docpath)
+        except OSError:
+            files = []
+    signature = []
+    for filename in files:
+        if (filename != ImgDoc.LABEL_FILE
+            and not filename[-4:].lower() in DocSearch.INDEX_FILE_EXTS):
+            continue
+        try:
+            mtime = os.path.getmtime(os.path.join(docpath, filename))
+        except OSError:
+            continue
+        signature.append((filename, mtime))
+    signature.sort()
+    return tuple(signature)
+
+
+def _read_doc_content(doc):
+    """
+    Read the keywords and the labels of a document
+
+    Returns:
+        A tuple (keywords, labels), where labels are tuples (name, color)
+    """
+    keywords = list(set(doc.keywords))
+    labels = [(label.name, label.get_color_str()) for label in doc.labels]
+    return (keywords, labels)
+
+
+def _read_doc_job(args):
+    """
+    Run by the indexing processes (see DocSearch.__read_docs()).
+
+    Arguments:
+        args --- tuple (docpath, docid)
+
+    Returns:
+        A tuple (docid, content, signature). content is None if the document
+        couldn't be read, the return value of _read_doc_content() otherwise.
+        signature is the one of the document once read (see
+        _get_doc_signature())
+    """
+    (docpath, docid) = args
+    try:
+        doc = DocSearch.get_doc(docpath, docid)
+        if doc is None:
+            return (docid, None, None)
+        content = _read_doc_content(doc)
+        # reading a document may add files to it (text extracted from
+        # PDFs for instance)
+        return (docid, content, _get_doc_signature(docpath))
+    except Exception, exc:
+        print "Warning: Unable to index '%s': %s" % (docid, exc)
+        return (docid, None, None)
+
 
 class DummyDocSearch(object):
     docs = []
@@ -55,7 +269,10 @@ class DummyDocSearch(object):
     def add_label(self, label):
         assert()
 
-    def redo_ocr(self, ocrlang, progress_callback):
+    def remove_label(self, label, doc):
+        assert()
+
+    def redo_ocr(self, ocrlang, progress_callback, can_run_cb=None):
         assert()
 
     def update_label(self, old_label, new_label, cb_progress=None):
@@ -77,7 +294,23 @@ class DocSearch(object):
     INDEX_STEP_SORTING = "sorting"
     LABEL_STEP_UPDATING = "label updating"
     LABEL_STEP_DESTROYING = "label deletion"
-    OCR_THREADS_POLLING_TIME = 0.5
+    # Maximum number of suggestions returned by find_suggestions()
+    MAX_SUGGESTIONS = 30
+
+    # Keywords and labels of each document are saved in this file (in the
+    # work directory) so we don't have to re-read all the documents each time
+    # Paperwork is started. Starts with a '.' --> ignored by __list_doc_dirs()
+    INDEX_FILE = ".paperwork_index"
+    INDEX_VERSION = 1
+    # Only those files affect the keywords and labels of a document
+    INDEX_FILE_EXTS = [".txt", ".pdf"]
+    # Below this number of documents to read, a pool of processes is not
+    # worth it
+    INDEX_PARALLEL_MIN_DOCS = 32
+    # Number of documents sent at once to each indexing process
+    INDEX_PARALLEL_CHUNK_SIZE = 8
+    # Maximum number of threads rewriting label files at the same time
+    LABEL_MAX_THREADS = 4
 
     def __init__(self, rootdir, callback=dummy_progress_cb):
         """
@@ -95,16 +328,24 @@ class DocSearch(object):
         self.rootdir = rootdir
 
         # we don't use __reset_data() here. Otherwise pylint won't be happy.
-        self.__keywords = []            # array of strings (sorted)
+        self.__keywords = _PrefixIndex()
         self.docs = []                # array of doc (sorted)
-        self.__keyword_to_docs = {}    # keyword (string) -> doc paths
+        # keyword (string) -> document ids (array('I'), sorted)
+        self.__keyword_to_docs = {}
+        # label key (see _get_label_key()) -> document ids (array('I'), sorted)
+        self.__label_to_docs = {}
+        self.__doc_ids = {}            # docid (string) -> document id (int)
+        self.__docs_by_id = []         # document id -> doc (None if removed)
         self.label_list = []
+        # docid -> { 'signature' : ..., 'keywords' : ..., 'labels' : ... }
+        self.__index_cache = {}
 
         self.__index(callback)
 
     @staticmethod
-    def get_doc(docpath, docid):
-        files = os.listdir(docpath)
+    def get_doc(docpath, docid, files=None):
+        if files is None:
+            files = os.listdir(docpath)
         for (is_doc_type, doc_type) in DOC_TYPE_LIST:
             if is_doc_type(files):
                 return doc_type(docpath, docid)
@@ -115,91 +356,349 @@ class DocSearch(object):
         """
         Purge the lists of documents and keywords
         """
-        self.__keywords = []
+        self.__keywords = _PrefixIndex()
         self.docs = []
         self.__keyword_to_docs = {}
+        self.__label_to_docs = {}
+        self.__doc_ids = {}
+        self.__docs_by_id = []
         self.label_list = []
+        self.__index_cache = {}
 
-    def __index_doc(self, doc, docs_set, keyword_to_docs):
+    def __load_index_cache(self):
         """
-        Add the keywords from the document to self.__keyword_to_docs
+        Load the index saved by a previous instance of Paperwork.
+
+        Returns:
+            A dict docid -> cache entry. Empty if there is no usable index.
         """
-        docs_set.add(doc)
-        for keyword in doc.keywords:
-            if keyword in keyword_to_docs:
-                docs = keyword_to_docs[keyword]
-                docs.add(doc)
-            else:
-                keyword_to_docs[keyword] = set([doc])
+        index_path = os.path.join(self.rootdir, self.INDEX_FILE)
+        try:
+            with open(index_path, 'rb') as file_desc:
+                (version, index_cache) = cPickle.load(file_desc)
+        except IOError:
+            return {}
+        except Exception, exc:
+            print "Warning: Unable to load index '%s': %s" % (index_path, exc)
+            return {}
+        if version != self.INDEX_VERSION:
+            print "Index '%s' is obsolete. Ignored" % (index_path)
+            return {}
+        print "Index loaded (%d documents)" % (len(index_cache))
+        return index_cache
+
+    def __save_index_cache(self):
+        """
+        Write self.__index_cache in the work directory. The file is written
+        aside first and then renamed, so a crash can't leave a truncated index
+        behind.
+        """
+        index_path = os.path.join(self.rootdir, self.INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as file_desc:
+                cPickle.dump((self.INDEX_VERSION, self.__index_cache),
+                             file_desc, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError), exc:
+            print "Warning: Unable to save index '%s': %s" % (index_path, exc)
 
-    def __index_dir(self, dirpath,
-                    docs_set, keyword_to_docs,
-                    callback=dummy_progress_cb):
+    @staticmethod
+    def __read_doc(doc, signature, index_cache):
         """
-        Look in the given directory for documents to index.
-        May also be called on the directory of a document itself.
+        Get the keywords and the labels of a document. They are taken from
+        the cache if the document hasn't changed since the last indexation.
+
+        Returns:
+            A cache entry (see self.__index_cache)
+        """
+        cached = index_cache.get(doc.docid)
+        if cached is not None and cached['signature'] == signature:
+            return cached
+        (keywords, labels) = _read_doc_content(doc)
+        # reading a document may add files to it (text extracted from
+        # PDFs for instance)
+        signature = _get_doc_signature(doc.path)
+        return {
+            'signature' : signature,
+            'keywords' : keywords,
+            'labels' : labels,
+        }
+
+    def __read_docs(self, to_read):
+        """
+        Read the keywords and labels of many documents. If there are enough
+        of them, they are read in parallel by a pool of processes (one per
+        CPU), and yielded in the order in which they are read.
 
         Arguments:
-            dirpath --- directory to explore
-            keywords_set --- set of keywords to complete
-            docs_set --- set of documents to complete
-            keyword_to_docs --- dict keyword->docs to complete
-            callback -- progression indicator callback (see
-                util.dummy_progress_cb)
+            to_read --- array of tuples (doc, signature)
+
+        Yields:
+            tuples (doc, cache entry)
+        """
+        if len(to_read) < self.INDEX_PARALLEL_MIN_DOCS:
+            for (doc, signature) in to_read:
+                yield (doc, self.__read_doc(doc, signature, {}))
+            return
+
+        docs = {}
+        for (doc, signature) in to_read:
+            docs[doc.docid] = (doc, signature)
+        print "Reading %d documents using %d processes" % (
+            len(to_read), multiprocessing.cpu_count())
+        pool = multiprocessing.Pool()
+        try:
+            results = pool.imap_unordered(
+                _read_doc_job, [(doc.path, doc.docid) for (doc, _) in to_read],
+                chunksize=self.INDEX_PARALLEL_CHUNK_SIZE)
+            for (docid, content, signature) in results:
+                (doc, _) = docs[docid]
+                if content is None:
+                    continue
+                (keywords, labels) = content
+                yield (doc, {
+                    'signature' : signature,
+                    'keywords' : keywords,
+                    'labels' : labels,
+                })
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def __get_entry_keywords(cached):
+        """
+        Yield all the keywords under which a document is indexed: its own
+        keywords and the words of its labels.
+        """
+        for keyword in cached['keywords']:
+            yield keyword
+        for (label_name, _) in cached['labels']:
+            for word in split_words(label_name):
+                yield word
+
+    def __add_posting(self, keyword, doc_id):
+        postings = self.__keyword_to_docs.get(keyword)
+        if postings is None:
+            self.__keyword_to_docs[keyword] = array.array('I', [doc_id])
+            self.__keywords.add(keyword)
+        else:
+            _insert_posting(postings, doc_id)
+
+    def __remove_posting(self, keyword, doc_id):
+        postings = self.__keyword_to_docs.get(keyword)
+        if postings is None:
+            return
+        _remove_posting(postings, doc_id)
+        if len(postings) <= 0:
+            del self.__keyword_to_docs[keyword]
+            self.__keywords.remove(keyword)
+
+    def __add_label_posting(self, label_name, doc_id):
+        key = _get_label_key(label_name)
+        postings = self.__label_to_docs.get(key)
+        if postings is None:
+            self.__label_to_docs[key] = array.array('I', [doc_id])
+        else:
+            _insert_posting(postings, doc_id)
+
+    def __remove_label_posting(self, label_name, doc_id):
+        key = _get_label_key(label_name)
+        postings = self.__label_to_docs.get(key)
+        if postings is None:
+            return
+        _remove_posting(postings, doc_id)
+        if len(postings) <= 0:
+            del self.__label_to_docs[key]
+
+    def __set_doc_labels(self, docid, labels):
+        """
+        Replace the labels of an indexed document in the index: updates
+        the label index and the postings of the words of the labels.
+
+        Arguments:
+            docid --- document id (string)
+            labels --- list of tuples (name, color)
+        """
+        cached = self.__index_cache[docid]
+        doc_id = self.__doc_ids[docid]
+        old_labels = cached['labels']
+        cached['labels'] = labels
+
+        old_keys = set([_get_label_key(name) for (name, _) in old_labels])
+        new_keys = set([_get_label_key(name) for (name, _) in labels])
+        for key in old_keys.difference(new_keys):
+            self.__remove_label_posting(key, doc_id)
+        for key in new_keys.difference(old_keys):
+            self.__add_label_posting(key, doc_id)
+
+        old_words = set()
+        for (name, _) in old_labels:
+            old_words.update(split_words(name))
+        new_words = set()
+        for (name, _) in labels:
+            new_words.update(split_words(name))
+        for word in old_words.difference(new_words):
+            # the word may also be in the text of the document
+            if not word in cached['keywords']:
+                self.__remove_posting(word, doc_id)
+        for word in new_words.difference(old_words):
+            self.__add_posting(word, doc_id)
+
+    def __index_doc(self, doc, cached):
+        """
+        Add a document and its keywords to the index
+        """
+        doc_id = len(self.__docs_by_id)
+        self.__index_cache[doc.docid] = cached
+        self.__doc_ids[doc.docid] = doc_id
+        self.__docs_by_id.append(doc)
+        bisect.insort(self.docs, doc)
+        if cached['signature'] is not None:
+            # the labels are up-to-date: spare the document from reading its
+            # label file again
+            doc.labels = [LABEL_TABLE.get_label(name, color)
+                          for (name, color) in cached['labels']]
+        for keyword in self.__get_entry_keywords(cached):
+            self.__add_posting(keyword, doc_id)
+        for (label_name, _) in cached['labels']:
+            self.__add_label_posting(label_name, doc_id)
+
+    def __unindex_doc(self, docid):
+        """
+        Remove a document and its keywords from the index
+        """
+        cached = self.__index_cache.pop(docid)
+        doc_id = self.__doc_ids.pop(docid)
+        doc = self.__docs_by_id[doc_id]
+        # document ids are never reused (until the next full indexation), so
+        # they keep being allocated in increasing order
+        self.__docs_by_id[doc_id] = None
+        idx = bisect.bisect_left(self.docs, doc)
+        if idx < len(self.docs) and self.docs[idx] == doc:
+            self.docs.pop(idx)
+        for keyword in self.__get_entry_keywords(cached):
+            self.__remove_posting(keyword, doc_id)
+        for (label_name, _) in cached['labels']:
+            self.__remove_label_posting(label_name, doc_id)
+
+    def __list_doc_dirs(self, dirpath):
+        """
+        List the directories of the documents in the given directory.
+
+        Returns:
+            An array of tuple (docid, docpath, files), sorted by docid
         """
         try:
             dlist = os.listdir(dirpath)
         except OSError, exc:
             print "Unable to read dir '%s': %s" % (dirpath, str(exc))
-            return
+            return []
         dlist.sort()
 
-        progression = 0
-        total = len(dlist)
-
+        doc_dirs = []
         for dpath in dlist:
             if dpath[:1] == "." or dpath[-1:] == "~":
-                progression = progression + 1
                 continue
-            elif os.path.isdir(os.path.join(dirpath, dpath)):
-                docpath = os.path.join(dirpath, dpath)
-                doc = self.get_doc(docpath, dpath)
-                if doc == None:
-                    continue
-                callback(progression, total, self.INDEX_STEP_READING, doc)
-                self.__index_doc(doc, docs_set, keyword_to_docs)
-                for label in doc.labels:
-                    self.add_label(label, doc)
-            progression = progression + 1
+            docpath = os.path.join(dirpath, dpath)
+            if not os.path.isdir(docpath):
+                continue
+            try:
+                files = os.listdir(docpath)
+            except OSError, exc:
+                print "Unable to read dir '%s': %s" % (docpath, str(exc))
+                continue
+            doc_dirs.append((dpath, docpath, files))
+        return doc_dirs
 
-    @staticmethod
-    def __docpath_to_id(docpath):
-        """
-        Generate a document id based on a document path.
+    def __update_index(self, index_cache, callback=dummy_progress_cb):
         """
-        try:
-            return os.path.split(docpath)[1]
-        except IndexError:
-            print "Warning: Invalid document path: %s" % (docpath)
-            return docpath
+        Bring the index up-to-date with the content of self.rootdir: Only the
+        documents added, modified or removed since they were last indexed are
+        (un)indexed.
 
-    def __sort_keywords(self, docs, keyword_to_docs,
-                        callback=dummy_progress_cb):
-        """
-        Sort and index all the keywords from all the documents
+        Arguments:
+            index_cache --- where to look for the keywords of the unmodified
+                documents not yet indexed (see __load_index_cache())
+            callback --- progression indicator callback (see
+                util.dummy_progress_cb)
         """
+        doc_dirs = self.__list_doc_dirs(self.rootdir)
 
-        callback(1, 4, self.INDEX_STEP_SORTING)
-        keywords = keyword_to_docs.keys()
-        docs = list(docs)
-        callback(2, 4, self.INDEX_STEP_SORTING)
-        keywords.sort()
-        callback(3, 4, self.INDEX_STEP_SORTING)
-        docs.sort()
+        progression = 0
+        total = len(doc_dirs)
+        on_disk = set()
+        (nb_added, nb_updated, nb_removed) = (0, 0, 0)
 
-        self.docs = docs
-        self.__keywords = keywords
-        self.__keyword_to_docs = keyword_to_docs
+        to_read = []
+
+        try:
+            for (docid, docpath, files) in doc_dirs:
+                progression += 1
+                signature = _get_doc_signature(docpath, files)
+                on_disk.add(docid)
+                current = self.__index_cache.get(docid)
+                if current is not None and current['signature'] == signature:
+                    continue
+                doc = self.get_doc(docpath, docid, files)
+                if doc == None:
+                    on_disk.discard(docid)
+                    continue
+                callback(progression, total, self.INDEX_STEP_READING, doc)
+                cached = index_cache.get(docid)
+                if cached is None or cached['signature'] != signature:
+                    # must be re-read. Done below, all at once
+                    to_read.append((doc, signature))
+                    continue
+                if current is not None:
+                    self.__unindex_doc(docid)
+                self.__index_doc(doc, cached)
+                nb_added += 1
+
+            progression = 0
+            total = len(to_read)
+            read_docs = self.__read_docs(to_read)
+            try:
+                for (doc, cached) in read_docs:
+                    progression += 1
+                    callback(progression, total, self.INDEX_STEP_READING,
+                             doc)
+                    if doc.docid in self.__index_cache:
+                        self.__unindex_doc(doc.docid)
+                        nb_updated += 1
+                    else:
+                        nb_added += 1
+                    self.__index_doc(doc, cached)
+            finally:
+                # stops the reading processes if we have been interrupted
+                read_docs.close()
+
+            for docid in self.__index_cache.keys():
+                if not docid in on_disk:
+                    self.__unindex_doc(docid)
+                    nb_removed += 1
+        finally:
+            print ("Index updated: %d documents added, %d updated,"
+                   " %d removed" % (nb_added, nb_updated, nb_removed))
+            self.__sort_labels()
+
+        callback(1, 2, self.INDEX_STEP_SORTING)
+        # merge the new keywords now instead of on the first search
+        self.__keywords.merge_pending()
+        callback(2, 2, self.INDEX_STEP_SORTING)
+        self.__save_index_cache()
+
+    def __sort_labels(self):
+        """
+        Rebuild the sorted list of the labels of all the documents
+        """
+        labels = set()
+        for cached in self.__index_cache.values():
+            labels.update(cached['labels'])
+        self.label_list = [LABEL_TABLE.get_label(name, color)
+                           for (name, color) in labels]
+        self.label_list.sort()
 
     def __index(self, callback=dummy_progress_cb):
         """
@@ -210,11 +709,37 @@ class DocSearch(object):
                 util.dummy_progress_cb)
         """
         self.__reset_data()
-        docs = set()
-        keyword_to_docs = {}
-        self.__index_dir(self.rootdir, docs, keyword_to_docs,
-                         callback=callback)
-        self.__sort_keywords(docs, keyword_to_docs, callback=callback)
+        index_cache = self.__load_index_cache()
+        self.__update_index(index_cache, callback=callback)
+
+    def reindex(self, callback=dummy_progress_cb):
+        """
+        Look for the documents added, modified or removed since the last
+        indexation, and update the index accordingly. Only the documents that
+        changed are re-read.
+
+        Arguments:
+            callback --- progression indicator callback (see
+                util.dummy_progress_cb). Only called for the documents that
+                are actually re-read.
+        """
+        self.__update_index(self.__index_cache, callback=callback)
+
+    def __get_doc_entry(self, doc):
+        """
+        Returns the cache entry of the given document. Create it if the
+        document is not indexed yet.
+        """
+        if doc.docid in self.__index_cache:
+            return self.__index_cache[doc.docid]
+        cached = {
+            # no signature: will be re-read on the next reindex()
+            'signature' : None,
+            'keywords' : [],
+            'labels' : [],
+        }
+        self.__index_doc(doc, cached)
+        return cached
 
     def index_page(self, page):
         """
@@ -223,17 +748,12 @@ class DocSearch(object):
         Arguments:
             page --- from which keywords must be extracted
         """
-        if not page.doc in self.docs:
-            self.docs.append(page.doc)
-            self.docs.sort()
-        for keyword in page.keywords:
-            if keyword in self.__keyword_to_docs:
-                docs = self.__keyword_to_docs[keyword]
-                docs.add(page.doc)
-            else:
-                self.__keyword_to_docs[keyword] = set([page.doc])
-                self.__keywords.append(keyword)
-        self.__keywords.sort()
+        cached = self.__get_doc_entry(page.doc)
+        doc_id = self.__doc_ids[page.doc.docid]
+        keywords = set(page.keywords)
+        cached['keywords'] = list(keywords.union(cached['keywords']))
+        for keyword in keywords:
+            self.__add_posting(keyword, doc_id)
 
     def __get_keyword_suggestions(self, keyword):
         """
@@ -250,60 +770,14 @@ class DocSearch(object):
         if neg:
             keyword = keyword[1:]
 
-        lkeyword = len(keyword)
-        lkeywords = len(self.__keywords)
-
-        if lkeyword < MIN_KEYWORD_LEN:
+        if len(keyword) < MIN_KEYWORD_LEN:
             return []
 
-        # the array is sorted. So we use dichotomy to
-        # figure the position of the first element matching the keyword
-        # and the position of the last one
-
-        # first element
-        njump = (lkeywords / 4) or 1
-        idx_min = lkeywords / 2
-        idx_min_found = False
-
-        while not idx_min_found:
-            if idx_min <= 0 or idx_min > lkeywords - 1:
-                idx_min_found = True
-            elif (self.__keywords[idx_min - 1][:lkeyword] < keyword
-                  and self.__keywords[idx_min][:lkeyword] > keyword):
-                print "No suggestion found for '%s'" % keyword
-                return []
-            elif (self.__keywords[idx_min - 1][:lkeyword] != keyword
-                  and self.__keywords[idx_min][:lkeyword] == keyword):
-                idx_min_found = True
-            elif self.__keywords[idx_min][:lkeyword] >= keyword:
-                idx_min = idx_min - njump
-            else:
-                idx_min = idx_min + njump
-            njump = (njump / 2) or 1
-
-        if idx_min > lkeywords - 1:
+        results = self.__keywords.find(keyword)
+        if len(results) <= 0:
             print "No suggestion found for '%s'" % keyword
             return []
 
-        # last element
-        njump = ((lkeywords - idx_min) / 4) or 1
-        idx_max = ((lkeywords - idx_min) / 2) + idx_min
-        idx_max_found = False
-
-        while not idx_max_found:
-            if idx_max <= 0 or idx_max >= lkeywords - 1:
-                idx_max_found = True
-            elif (self.__keywords[idx_max + 1][:lkeyword] != keyword
-                  and self.__keywords[idx_max][:lkeyword] == keyword):
-                idx_max_found = True
-            elif self.__keywords[idx_max][:lkeyword] <= keyword:
-                idx_max = idx_max + njump
-            else:
-                idx_max = idx_max - njump
-            njump = (njump / 2) or 1
-
-        results = self.__keywords[idx_min:(idx_max + 1)]
-
         if neg:
             results = [("!%s" % (result)) for result in results]
 
@@ -314,30 +788,50 @@ class DocSearch(object):
     def __find_suggestions(self, keywords):
         """
         see DocSearch.find_suggestions().
+
+        Keywords are completed one after the other. Each partial suggestion
+        keeps the set of documents it matches, so completing the next keyword
+        only costs an intersection with this set. Partial suggestions
+        matching no document are dropped, and only the MAX_SUGGESTIONS ones
+        matching the most documents are kept at each step.
+
+        Returns:
+            An array of tuples (suggestion, number of matching documents),
+            most frequent first
         """
         if len(keywords) <= 0:
             return []
 
-        # search suggestion for the first keywords
-        first_keyword_suggestions = self.__get_keyword_suggestions(keywords[0])
-        if len(keywords) <= 1:
-            return first_keyword_suggestions
-
-        results = []
-
-        # .. and for all the remaining keywords
-        # XXX(Jflesch): recursivity
-        other_keywords_suggestions = self.__find_suggestions(keywords[1:])
-
-        for first_keyword_suggestion in first_keyword_suggestions:
-            for suggestion in other_keywords_suggestions:
-                suggestion = first_keyword_suggestion + " " + suggestion
-                # immediatly look if it has matching documents
-                if len(self.find_documents(suggestion)) <= 0:
-                    continue
-                results.append(suggestion)
+        all_docs = None
+        # array of tuples (words, matching documents). None == all the docs
+        candidates = [([], None)]
+
+        for keyword in keywords:
+            completions = self.__get_keyword_suggestions(keyword)
+            new_candidates = []
+            for (words, docs) in candidates:
+                for completion in completions:
+                    neg = (completion[:1] == "!")
+                    postings = self.__find_documents(completion.lstrip("!"))
+                    if neg:
+                        if docs is None:
+                            if all_docs is None:
+                                all_docs = self.__get_all_doc_ids()
+                            docs = all_docs
+                        matching = _difference(docs, postings)
+                    elif docs is None:
+                        matching = postings
+                    else:
+                        matching = _intersect(docs, postings)
+                    if len(matching) <= 0:
+                        continue
+                    new_candidates.append((words + [completion], matching))
+            if len(new_candidates) <= 0:
+                return []
+            new_candidates.sort(key=lambda candidate: -len(candidate[1]))
+            candidates = new_candidates[:self.MAX_SUGGESTIONS]
 
-        return results
+        return [(" ".join(words), len(docs)) for (words, docs) in candidates]
 
     def find_suggestions(self, sentence):
         """
@@ -349,15 +843,17 @@ class DocSearch(object):
                 suggestions
         Return:
             An array of sets of keywords. Each set of keywords (-> one string)
-            is a suggestion.
+            is a suggestion. The suggestions matching the most documents come
+            first.
         """
         keywords = split_words(sentence)
         results = self.__find_suggestions([x for x in keywords])
+        results.sort(key=lambda result: (-result[1], result[0]))
+        results = [suggestion for (suggestion, _) in results]
         try:
             results.remove(sentence)    # remove strict match if it is here
         except ValueError:
             pass
-        results.sort()
         return results
 
     def __find_documents(self, keyword):
@@ -368,19 +864,85 @@ class DocSearch(object):
             keyword --- one keyword (string)
 
         Returns:
-            An array of docs
+            A posting list (sorted array of document ids). Must not be
+            modified.
         """
         try:
             return self.__keyword_to_docs[keyword]
         except KeyError:
-            return set()
+            return array.array('I')
+
+    def __find_labeled_documents(self, label_name):
+        """
+        Returns all the documents having the given label
+
+        Returns:
+            A posting list (sorted array of document ids). Must not be
+            modified.
+        """
+        try:
+            return self.__label_to_docs[_get_label_key(label_name)]
+        except KeyError:
+            return array.array('I')
+
+    def __get_all_doc_ids(self):
+        """
+        Returns the posting list of all the indexed documents
+        """
+        return array.array('I', [doc_id
+                                 for (doc_id, doc)
+                                 in enumerate(self.__docs_by_id)
+                                 if doc is not None])
+
+    def __get_docs(self, postings):
+        """
+        Convert a posting list into a sorted list of documents
+        """
+        docs = [self.__docs_by_id[doc_id] for doc_id in postings]
+        docs.sort()
+        return docs
+
+    def __execute_query(self, positives, negatives):
+        """
+        Look for the documents in all the positive posting lists and in none
+        of the negative ones. The posting lists of the index are never
+        modified.
+
+        Returns:
+            A posting list
+        """
+        # smallest posting lists first: the intersection can only get
+        # smaller, so the following intersections get cheaper, and we
+        # can stop as soon as it is empty
+        positives = sorted(positives, key=len)
+        if len(positives) <= 0:
+            # only negative keywords: all the documents minus the ones
+            # matching them
+            documents = self.__get_all_doc_ids()
+        else:
+            documents = positives[0]
+            for postings in positives[1:]:
+                if len(documents) <= 0:
+                    break
+                documents = _intersect(documents, postings)
+
+        for postings in negatives:
+            if len(documents) <= 0:
+                break
+            print "Found %d documents to remove" % (len(postings))
+            documents = _difference(documents, postings)
+
+        return documents
 
     def find_documents(self, sentence):
         """
         Returns all the documents matching the given keywords
 
         Arguments:
-            keywords --- keywords (single string)
+            keywords --- keywords (single string). 'label:<name>' (or
+                'label:"<name>"' if the name contains spaces) only matches
+                the documents having this label (case insensitive).
+                Like keywords, it can be negated with '!'.
 
         Returns:
             An array of document id (strings)
@@ -389,46 +951,35 @@ class DocSearch(object):
         if sentence.strip() == "":
             return self.docs[:]
 
-        positive_keywords = []
-        negative_keywords = []
+        positives = []
+        negatives = []
 
         print ("Looking for documents containing %s"
                % (sentence.encode('ascii', 'replace')))
 
-        for keyword in split_words(sentence):
-            if keyword[:1] != "!":
-                positive_keywords.append(keyword)
+        for match in LABEL_QUERY_REGEX.finditer(sentence):
+            label_name = match.group(2)
+            if label_name is None:
+                label_name = match.group(3)
+            postings = self.__find_labeled_documents(label_name)
+            if match.group(1) != "!":
+                positives.append(postings)
             else:
-                negative_keywords.append(keyword[1:])
+                negatives.append(postings)
+        sentence = LABEL_QUERY_REGEX.sub(u" ", sentence)
 
-        if (len(positive_keywords) == 0 and len(negative_keywords) == 0):
-            return []
-
-        documents = None
-
-        if len(positive_keywords) <= 0:
-            positive_keywords = ["*"]
-
-        for keyword in positive_keywords:
-            docs = self.__find_documents(keyword)
-            if documents == None:
-                documents = docs
+        for keyword in split_words(sentence):
+            if keyword[:1] != "!":
+                positives.append(self.__find_documents(keyword))
             else:
-                documents.intersection_update(docs)
+                negatives.append(self.__find_documents(keyword[1:]))
 
-        if documents == None:
+        if (len(positives) == 0 and len(negatives) == 0):
             return []
 
+        documents = self.__execute_query(positives, negatives)
         print "Found %d documents" % (len(documents))
-
-        for keyword in negative_keywords:
-            docs = self.__find_documents(keyword)
-            print "Found %d documents to remove" % (len(documents))
-            documents.symmetric_difference_update(docs)
-
-        documents = list(documents)
-        documents.sort()
-        return documents
+        return self.__get_docs(documents)
 
     def add_label(self, label, doc):
         """
@@ -438,80 +989,159 @@ class DocSearch(object):
             label --- The new label (see labels.Label)
             doc --- The first document on which this label has been added
         """
-        label_words = split_words(label.name)
-        for word in label_words:
-            if not word in self.__keyword_to_docs:
-                self.__keywords.append(word)
-                self.__keywords.sort()
-                self.__keyword_to_docs[word] = set([doc])
-            else:
-                self.__keyword_to_docs[word].add(doc)
+        cached = self.__get_doc_entry(doc)
+        label_tuple = (label.name, label.get_color_str())
+        if not label_tuple in cached['labels']:
+            self.__set_doc_labels(doc.docid, cached['labels'] + [label_tuple])
         if not label in self.label_list:
-            self.label_list.append(label)
+            self.label_list.append(LABEL_TABLE.get_label(*label_tuple))
             self.label_list.sort()
 
-    def redo_ocr(self, ocrlang, progress_callback=dummy_progress_cb):
+    def remove_label(self, label, doc):
+        """
+        Remove a label of a document from the index. The label remains in
+        the list of known labels.
+
+        Arguments:
+            label --- The label removed (see labels.Label)
+            doc --- The document from which the label has been removed
+        """
+        self.__replace_doc_label(doc.docid,
+                                 (label.name, label.get_color_str()))
+
+    def __replace_doc_label(self, docid, old_label, new_label=None):
+        """
+        Replace or remove a label of a document in the index
+
+        Arguments:
+            docid --- document id (string)
+            old_label --- tuple (name, color)
+            new_label --- tuple (name, color). None to only remove old_label
+        """
+        cached = self.__index_cache.get(docid)
+        if cached is None or not old_label in cached['labels']:
+            return
+        labels = [label for label in cached['labels'] if label != old_label]
+        if new_label is not None and not new_label in labels:
+            labels.append(new_label)
+        self.__set_doc_labels(docid, labels)
+
+    def redo_ocr(self, ocrlang, progress_callback=dummy_progress_cb,
+                 can_run_cb=None):
         """
         Rerun the OCR on *all* the documents. Can be a *really* long process,
         which is why progress_callback is a mandatory argument.
 
+        The pages of all the documents are OCR'd in parallel, most recent
+        documents first (see page.redo_pages_ocr()), so a big document
+        doesn't keep all the other processors waiting.
+
         Arguments:
             progress_callback --- See util.dummy_progress_cb for a
-                prototype. The only step returned is "INDEX_STEP_READING"
+                prototype. Called each time a page is done. The only step
+                returned is BasicPage.SCAN_STEP_OCR
             ocrlang --- Language to specify to the OCR tool (see
                 config.PaperworkConfig.ocrlang)
+            can_run_cb --- Called each time a page is done. If it returns
+                False, the OCR is stopped
         """
         print "Redoing OCR of all documents ..."
 
-        dlist = os.listdir(self.rootdir)
-        threads = []
-        remaining = dlist[:]
+        # document ids are their creation dates: most recent ones first
+        docs = self.docs[::-1]
+        nb_pages = 0
+        for doc in docs:
+            nb_pages += doc.nb_pages
+        pages = (doc.pages[page_nb]
+                 for doc in docs
+                 for page_nb in xrange(0, doc.nb_pages))
+        redo_pages_ocr(pages, nb_pages, ocrlang, progress_callback,
+                       can_run_cb)
+        print "OCR of all documents done"
 
-        max_threads = multiprocessing.cpu_count()
+    def __get_labeled_docs(self, label):
+        """
+        Returns:
+            The documents having this label (same name and color)
+        """
+        label_tuple = (label.name, label.get_color_str())
+        docs = self.__get_docs(self.__find_labeled_documents(label.name))
+        # the label index ignores colors
+        return [doc for doc in docs
+                if label_tuple in self.__index_cache[doc.docid]['labels']]
 
-        while (len(remaining) > 0 or len(threads) > 0):
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-            while (len(threads) < max_threads and len(remaining) > 0):
-                docid = remaining.pop()
-                docpath = os.path.join(self.rootdir, docid)
-                doc = self.get_doc(docpath, docid)
-                if doc == None:
-                    continue
-                thread = threading.Thread(target=doc.redo_ocr,
-                                          args=[ocrlang], name=docid)
-                thread.start()
-                threads.append(thread)
-                progress_callback(len(dlist) - len(remaining),
-                                  len(dlist), self.INDEX_STEP_READING,
-                                  doc)
-            time.sleep(self.OCR_THREADS_POLLING_TIME)
-        print "OCR of all documents done"
+    def __run_on_docs(self, docs, func, step, callback):
+        """
+        Call func(doc) on all the documents, using at most
+        LABEL_MAX_THREADS threads. The callback is called from the calling
+        thread each time a document is done.
+
+        Returns:
+            The documents successfully handled, in the order they were done
+        """
+        total = len(docs)
+        todo = Queue.Queue()
+        for doc in docs:
+            todo.put(doc)
+        done = Queue.Queue()
+
+        def run():
+            while True:
+                try:
+                    doc = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    func(doc)
+                    done.put((doc, None))
+                except Exception, exc:
+                    done.put((doc, exc))
+
+        threads = [threading.Thread(target=run)
+                   for _ in range(0, min(total, self.LABEL_MAX_THREADS))]
+        for thread in threads:
+            thread.start()
+        handled = []
+        for current in range(0, total):
+            (doc, exc) = done.get()
+            if exc is None:
+                handled.append(doc)
+            else:
+                print "Warning: Failed to update document %s: %s" % (
+                    str(doc), str(exc))
+            callback(current + 1, total, step, doc)
+        for thread in threads:
+            thread.join()
+        return handled
 
     def update_label(self, old_label, new_label, callback=dummy_progress_cb):
         """
-        Replace 'old_label' by 'new_label' on all the documents
+        Replace 'old_label' by 'new_label' on all the documents having it.
+        The label files of the documents are rewritten in parallel.
         """
         self.label_list.remove(old_label)
         if new_label not in self.label_list:
-            self.label_list.append(new_label)
+            self.label_list.append(LABEL_TABLE.get_label(
+                new_label.name, new_label.get_color_str()))
         self.label_list.sort()
-        current = 0
-        total = len(self.docs)
-        for doc in self.docs:
-            callback(current, total, self.LABEL_STEP_UPDATING, doc)
-            doc.update_label(old_label, new_label)
-            current += 1
+        old_tuple = (old_label.name, old_label.get_color_str())
+        new_tuple = (new_label.name, new_label.get_color_str())
+        docs = self.__get_labeled_docs(old_label)
+        docs = self.__run_on_docs(
+            docs, lambda doc: doc.update_label(old_label, new_label),
+            self.LABEL_STEP_UPDATING, callback)
+        for doc in docs:
+            self.__replace_doc_label(doc.docid, old_tuple, new_tuple)
 
     def destroy_label(self, label, callback=dummy_progress_cb):
         """
-        Remove the label 'label' from all the documents
+        Remove the label 'label' from all the documents having it.
+        The label files of the documents are rewritten in parallel.
         """
         self.label_list.remove(label)
-        current = 0
-        total = len(self.docs)
-        for doc in self.docs:
-            callback(current, total, self.LABEL_STEP_DESTROYING, doc)
-            doc.remove_label(label)
-            current += 1
+        label_tuple = (label.name, label.get_color_str())
+        docs = self.__get_labeled_docs(label)
+        docs = self.__run_on_docs(docs, lambda doc: doc.remove_label(label),
+                                  self.LABEL_STEP_DESTROYING, callback)
+        for doc in docs:
+            self.__replace_doc_label(doc.docid, label_tuple)
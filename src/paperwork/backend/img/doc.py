@@ -62,11 +62,11 @@ class ImgToPdfDocExporter(object):
         quality = float(self.__quality) / 100.0
 
         for page in [self.doc.pages[x] for x in range(pages[0], pages[1])]:
-            img = page.img
-            if (img.size[0] > img.size[1]):
+            (width, height) = page.get_image_size()
+            new_size = (int(quality * width), int(quality * height))
+            img = page.get_image(new_size[0])
+            if (width > height):
                 img = img.rotate(90)
-            new_size = (int(quality * img.size[0]),
-                        int(quality * img.size[1]))
             img = img.resize(new_size, Image.ANTIALIAS)
 
             scale_factor_x = float(pdf_format[0]) / img.size[0]
@@ -196,8 +196,13 @@ class ImgDoc(BasicDoc):
             docid --- Document Id (ie folder name). Use None for a new document
         """
         BasicDoc.__init__(self, docpath, docid)
+        self.__nb_pages = None
 
-    def __get_nb_pages(self):
+    def drop_cache(self):
+        BasicDoc.drop_cache(self)
+        self.__nb_pages = None
+
+    def __count_pages(self):
         """
         Compute the number of pages in the document. It basically counts
         how many JPG files there are in the document.
@@ -218,6 +223,15 @@ class ImgDoc(BasicDoc):
                    "'%s': %s" % (self.docid, exc))
             return 0
 
+    def __get_nb_pages(self):
+        """
+        Number of pages in the document. Counted only once: Page additions
+        and removals made by Paperwork call drop_cache().
+        """
+        if self.__nb_pages is None:
+            self.__nb_pages = self.__count_pages()
+        return self.__nb_pages
+
     nb_pages = property(__get_nb_pages)
 
     def __add_img(self, img, ocrlang=None, resolution=0, scanner_calibration=None,
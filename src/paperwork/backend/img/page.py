@@ -22,84 +22,22 @@ Code relative to page handling.
 import codecs
 from copy import copy
 import Image
-import multiprocessing
 import os
 import os.path
-import re
-import threading
-import time
 
 import gtk
 import pyocr.builders
 import pyocr.pyocr
 
+from paperwork.backend.common.ocr import get_ocr_pool
 from paperwork.backend.common.page import BasicPage
 from paperwork.backend.common.page import PageExporter
+from paperwork.backend.common.thumbnails import get_thumbnail_cache
 from paperwork.backend.config import PaperworkConfig
-from paperwork.util import check_spelling
 from paperwork.util import dummy_progress_cb
 from paperwork.util import split_words
 
 
-class ImgOCRThread(threading.Thread):
-    def __init__(self, ocr_tool, ocr_lang, imgpath):
-        threading.Thread.__init__(self, name="OCR")
-        self.ocr_tool = ocr_tool
-        self.ocr_lang = ocr_lang
-        self.imgpath = imgpath
-        self.score = -1
-        self.text = None
-
-    def __compute_ocr_score_with_spell_checking(self, txt):
-        return check_spelling(self.ocr_lang, txt)
-
-    @staticmethod
-    def __compute_ocr_score_without_spell_checking(txt):
-        """
-        Try to evaluate how well the OCR worked.
-        Current implementation:
-            The score is the number of words only made of 4 or more letters
-            ([a-zA-Z])
-        """
-        # TODO(Jflesch): i18n / l10n
-        score = 0
-        prog = re.compile(r'^[a-zA-Z]{4,}$')
-        for word in txt.split(" "):
-            if prog.match(word):
-                score += 1
-        return (txt, score)
-
-    def run(self):
-        SCORE_METHODS = [
-            ("spell_checker", self.__compute_ocr_score_with_spell_checking),
-            ("lucky_guess", self.__compute_ocr_score_without_spell_checking),
-            ("no_score", lambda txt: (txt, 0))
-        ]
-
-        img = Image.open(self.imgpath)
-
-        print ("Running OCR on '%s'" % self.imgpath)
-        self.text = self.ocr_tool.image_to_string(img, lang=self.ocr_lang)
-
-        for score_method in SCORE_METHODS:
-            try:
-                print ("Evaluating score of this page orientation (%s)"
-                       " using method '%s' ..."
-                       % (self.imgpath, score_method[0]))
-                (fixed_text, self.score) = score_method[1](self.text)
-                # TODO(Jflesch): For now, we throw away the fixed version:
-                # The original version may contain proper nouns, and spell
-                # checking could make them disappear
-                # However, it would be best if we could keep both versions
-                # without increasing too much indexation time
-                print "Page orientation score: %d" % self.score
-                return
-            except Exception, exc:
-                print ("**WARNING** Scoring method '%s' failed !"
-                       % score_method[0])
-                print ("Reason: %s" % (str(exc)))
-
-
 class ImgPage(BasicPage):
     """
     Represents a page. A page is a sub-element of ImgDoc.
@@ -107,7 +45,6 @@ class ImgPage(BasicPage):
     FILE_PREFIX = "paper."
     EXT_TXT = "txt"
     EXT_BOX = "words"
-    EXT_IMG_SCAN = "bmp"
     EXT_IMG = "jpg"
     EXT_THUMB = "thumb.jpg"
 
@@ -118,7 +55,19 @@ class ImgPage(BasicPage):
     ORIENTATION_PORTRAIT = 0
     ORIENTATION_LANDSCAPE = 1
 
-    OCR_THREADS_POLLING_TIME = 0.1
+    # Once an orientation reaches this score and has more than twice the
+    # score of every other orientation already looked at (at least one), the
+    # OCR of the remaining orientations is stopped
+    OCR_WINNING_SCORE = 20
+
+    # The orientation is first looked for on the center of the page, scaled
+    # down to this resolution (dpi) ...
+    ORIENTATION_DETECTION_RESOLUTION = 150
+    # ... and on this part of the width and height of the page
+    ORIENTATION_DETECTION_AREA = 0.6
+    # Below this score, the detection is considered as failed and all the
+    # orientations are looked at in full resolution
+    ORIENTATION_DETECTION_MIN_SCORE = 5
 
     def __init__(self, doc, page_nb):
         BasicPage.__init__(self, doc, page_nb)
@@ -154,14 +103,6 @@ class ImgPage(BasicPage):
 
     __img_path = property(__get_img_path)
 
-    def __get_thumb_path(self):
-        """
-        Returns the file path of the thumbnail corresponding to this page
-        """
-        return self.__get_filepath(self.EXT_THUMB)
-
-    __thumb_path = property(__get_thumb_path)
-
     def __get_text(self):
         """
         Get the text corresponding to this page
@@ -198,6 +139,13 @@ class ImgPage(BasicPage):
 
     boxes = property(__get_boxes)
 
+    def _get_boxes_cache_key(self):
+        boxfile = self.__box_path
+        try:
+            return (boxfile, os.path.getmtime(boxfile))
+        except OSError:
+            return None
+
     def __get_img(self):
         """
         Returns an image object corresponding to the page
@@ -206,45 +154,47 @@ class ImgPage(BasicPage):
 
     img = property(__get_img)
 
-    def __make_thumbnail(self, width):
+    def get_image(self, max_width=None):
+        """
+        See BasicPage.get_image(). If the full resolution is not needed, the
+        JPEG file is decoded directly at 1/2, 1/4 or 1/8 of its size (draft
+        mode), which is much faster.
+        """
+        img = Image.open(self.__img_path)
+        if max_width is not None and img.size[0] > max_width:
+            max_height = (max_width * img.size[1] + img.size[0] - 1) \
+                    / img.size[0]
+            img.draft(img.mode, (max_width, max_height))
+        return img
+
+    def _get_image_cache_key(self):
+        imgfile = self.__img_path
+        try:
+            return (imgfile, os.path.getmtime(imgfile))
+        except OSError:
+            return None
+
+    def _make_thumbnail(self, width):
         """
         Create the page's thumbnail
         """
-        img = self.img
+        img = self.get_image(width)
         (w, h) = img.size
         factor = (float(w) / width)
         w = width
         h /= factor
-        img = img.resize((int(w), int(h)), Image.ANTIALIAS)
-        img.save(self.__thumb_path)
-        return img
-
-    def __get_thumbnail(self):
-        """
-        Returns an image object corresponding to the last saved thumbnail
-        """
-        return Image.open(self.__thumb_path)
+        return img.resize((int(w), int(h)), Image.ANTIALIAS)
 
-    def get_thumbnail(self, width):
-        """
-        Returns an image object corresponding to the up-to-date thumbnail
-        """
+    def _get_thumbnail_source_mtime(self):
         try:
-            if os.path.getmtime(self.__img_path) > \
-               os.path.getmtime(self.__thumb_path):
-                return self.__make_thumbnail(width)
-            else:
-                return self.__get_thumbnail()
-        except:
-            return self.__make_thumbnail(width)
+            return os.path.getmtime(self.__img_path)
+        except OSError:
+            return None
 
-    def __save_imgs(self, img, scan_res=0, scanner_calibration=None,
-                    callback=dummy_progress_cb):
+    @staticmethod
+    def __prepare_img(img, scan_res=0, scanner_calibration=None):
         """
-        Make a page (on disk), and generate 4 output files:
-            <docid>/paper.rotated.0.bmp: original output
-            <docid>/paper.rotated.1.bmp: original output at 90 degrees
-        OCR will have to decide which is the best
+        Crop the scan according to the calibration and make it RGB
         """
         print "Scanner resolution: %d" % (scan_res)
         print "Scanner calibration: %s" % (str(scanner_calibration))
@@ -269,124 +219,185 @@ class ImgPage(BasicPage):
         # strip the alpha channel if there is one
         color_channels = img.split()
         img = Image.merge("RGB", color_channels[:3])
-
-        outfiles = []
-        # rotate the image 0, 90, 180 and 270 degrees
-        for rotation in range(0, 4):
-            imgpath = os.path.join(self.doc.path,
-                    ("rotated.%d.%s" % (rotation, self.EXT_IMG_SCAN)))
-            print ("Saving scan (rotated %d degree) in '%s'"
-                   % (rotation * -90, imgpath))
-            img.save(imgpath)
-            outfiles.append(imgpath)
-            img = img.rotate(-90)
-        return outfiles
+        return img
 
     @staticmethod
-    def __compare_score(score_x, score_y):
+    def __rotate_img(img, rotation):
+        """
+        Rotate the image by rotation * 90 degrees clockwise. Lossless.
         """
-        Compare scores
+        transpositions = [None, Image.ROTATE_270, Image.ROTATE_180,
+                          Image.ROTATE_90]
+        if transpositions[rotation] is None:
+            return img
+        return img.transpose(transpositions[rotation])
 
+    def __is_winning_score(self, score, other_scores):
+        """
         Returns:
-            -1 : if X is lower than Y
-            1 : if X is higher than Y
-            0 : if both are equal
-        """
-        if score_x < score_y:
-            return -1
-        elif score_x > score_y:
-            return 1
-        else:
-            return 0
+            True if an orientation with this score is obviously the right
+            one, compared to the orientations already looked at
+        """
+        if score < self.OCR_WINNING_SCORE:
+            return False
+        # a score alone can't tell: all the orientations of a page with big
+        # letters or numbers may get good scores
+        if len(other_scores) <= 0:
+            return False
+        for other_score in other_scores:
+            if score <= 2 * other_score:
+                return False
+        return True
 
-    def __ocr(self, files, ocrlang, callback=dummy_progress_cb):
+    @staticmethod
+    def __check_ocr_tool():
         """
-        Do the OCR on the page
+        Returns:
+            The OCR tool to use
         """
-
-        files = files[:]
-
-        callback(0, 100, self.SCAN_STEP_OCR)
-
         ocr_tools = pyocr.pyocr.get_available_tools()
         if len(ocr_tools) <= 0:
             # shouldn't happen: scan buttons should be disabled
             # in that case
-            callback(0, 100, self.SCAN_STEP_OCR)
             raise Exception("No OCR tool available")
-        print "Using %s for OCR" % (ocr_tools[0].get_name())
+        return ocr_tools[0]
 
-        #max_threads = multiprocessing.cpu_count()
-        max_threads = 1
-        threads = []
-        print "Will use %d process(es) for OCR" % (max_threads)
+    def __ocr_orientations(self, orientations, ocrlang,
+                           callback=dummy_progress_cb):
+        """
+        OCR several orientations of a page, in parallel in the OCR pool. As
+        soon as an orientation obviously wins, the others are dropped.
 
-        scores = []
+        Arguments:
+            orientations --- list of tuples (orientation, PIL image)
 
-        # Run the OCR tools in as many threads as there are processors/core
-        # on the computer
-        while (len(files) > 0 or len(threads) > 0):
-            # look for finished threads
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-                    scores.append((thread.score, thread.imgpath, thread.text))
-                    callback(len(scores),
-                             len(scores) + len(files) + len(threads) + 1,
-                             self.SCAN_STEP_OCR)
-            # start new threads if required
-            while (len(threads) < max_threads and len(files) > 0):
-                imgpath = files.pop()
-                thread = ImgOCRThread(ocr_tools[0], ocrlang, imgpath)
-                thread.start()
-                threads.append(thread)
-            time.sleep(self.OCR_THREADS_POLLING_TIME)
+        Returns:
+            A list of tuples (score, orientation, text, boxes). Higher score
+            first.
+        """
+        scores = []
+        for (orientation, score, text, boxes) in get_ocr_pool().run(
+                orientations, ocrlang, with_score=True):
+            print ("Page orientation score (%s): %d"
+                   % (str(orientation), score))
+            if self.__is_winning_score(score, [x[0] for x in scores]):
+                print "Orientation %s wins" % str(orientation)
+                scores = [(score, orientation, text, boxes)]
+                break
+            scores.append((score, orientation, text, boxes))
+            callback(len(scores), len(orientations), self.SCAN_STEP_OCR)
+
+        if len(scores) <= 0:
+            raise Exception("OCR failed")
 
         # We want the higher score first
-        scores.sort(cmp=lambda x, y: self.__compare_score(y[0], x[0]))
+        scores.sort(key=lambda x: x[0], reverse=True)
+        return scores
 
-        print "Best: %f -> %s" % (scores[0][0], scores[0][1])
+    def __detect_orientation(self, img, ocrlang, scan_res=0,
+                             callback=dummy_progress_cb):
+        """
+        Look for the orientation of the page using a scaled down version
+        of its center. Much faster than OCR'ing all the orientations in
+        full resolution.
 
-        print "Extracting boxes ..."
-        callback(len(scores), len(scores) + 1, self.SCAN_STEP_OCR)
-        boxes = ocr_tools[0].image_to_string(Image.open(scores[0][1]),
-                lang=ocrlang, builder=pyocr.builders.WordBoxBuilder())
-        print "Done"
+        Returns:
+            A tuple (rotation, score). rotation is the number of times the
+            page must be rotated by 90 degrees clockwise, or None if the
+            orientation couldn't be found.
+        """
+        factor = 2.0
+        if scan_res > 0:
+            factor = (float(scan_res)
+                      / self.ORIENTATION_DETECTION_RESOLUTION)
+        factor = max(factor, 1.0)
+        (width, height) = img.size
+        side = int(min(width, height) * self.ORIENTATION_DETECTION_AREA)
+        left = (width - side) / 2
+        top = (height - side) / 2
+        center = img.crop((left, top, left + side, top + side))
+        small_side = max(int(side / factor), 1)
+        center = center.resize((small_side, small_side), Image.ANTIALIAS)
+
+        orientations = [(rotation, self.__rotate_img(center, rotation))
+                        for rotation in range(0, 4)]
+
+        scores = self.__ocr_orientations(orientations, ocrlang, callback)
+        (score, rotation) = (scores[0][0], scores[0][1])
+        print ("Orientation detection: rotation %d degrees, score %d"
+               % (rotation * 90, score))
+        if score < self.ORIENTATION_DETECTION_MIN_SCORE:
+            print "Orientation detection failed"
+            return (None, score)
+        return (rotation, score)
+
+    def __ocr(self, orientations, ocrlang, callback=dummy_progress_cb):
+        """
+        Do the OCR on the page. If several orientations are given, the best
+        one is kept.
+
+        Arguments:
+            orientations --- list of tuples (orientation, PIL image)
+
+        Returns:
+            A tuple (best orientation, text, boxes)
+        """
+        callback(0, 100, self.SCAN_STEP_OCR)
+        ocr_tool = self.__check_ocr_tool()
+        print "Using %s for OCR" % (ocr_tool.get_name())
+
+        if len(orientations) <= 1:
+            (orientation, img) = orientations[0]
+            (score, text, boxes) = get_ocr_pool().ocr(img, ocrlang,
+                                                      with_score=True)
+            best = (score, orientation, text, boxes)
+        else:
+            best = self.__ocr_orientations(orientations, ocrlang,
+                                           callback)[0]
+
+        print "Best: %f -> %s" % (best[0], str(best[1]))
 
         callback(100, 100, self.SCAN_STEP_OCR)
-        return (scores[0][1], scores[0][2], boxes)
+        return (best[1], best[2], best[3])
+
+    def _save_ocr_result(self, txt, boxes):
+        """
+        See BasicPage._save_ocr_result()
+        """
+        with codecs.open(self.__txt_path, 'w', encoding='utf-8') as file_desc:
+            file_desc.write(txt)
+        with codecs.open(self.__box_path, 'w', encoding='utf-8') as file_desc:
+            pyocr.builders.WordBoxBuilder().write_file(file_desc, boxes)
 
     def make(self, img, ocrlang=None, scan_res=0, scanner_calibration=None,
                   callback=dummy_progress_cb):
         """
-        Scan the page & do OCR
+        Scan the page & do OCR. The rotations of the scan are only made in
+        memory: only the final image, text and boxes are written.
         """
-        imgfile = self.__img_path
-        txtfile = self.__txt_path
-        boxfile = self.__box_path
-
-        outfiles = self.__save_imgs(img, scan_res, scanner_calibration,
-                                    callback)
+        img = self.__prepare_img(img, scan_res, scanner_calibration)
         if ocrlang is None:
-            (bmpfile, txt, boxes) = (outfiles[0], "", [])
+            (txt, boxes) = ("", [])
         else:
-            (bmpfile, txt, boxes) = self.__ocr(outfiles, ocrlang, callback)
-
-        # Convert the image and save it in its final place
-        img = Image.open(bmpfile)
-        img.save(imgfile)
-
-        # Save the text
-        with open(txtfile, 'w') as file_desc:
-            file_desc.write(txt)
+            callback(0, 100, self.SCAN_STEP_OCR)
+            self.__check_ocr_tool()
+            (rotation, score) = self.__detect_orientation(img, ocrlang,
+                                                          scan_res, callback)
+            if rotation is not None:
+                rotations = [rotation]
+            else:
+                rotations = range(0, 4)
+            orientations = [(rotation, self.__rotate_img(img, rotation))
+                            for rotation in rotations]
+            (rotation, txt, boxes) = self.__ocr(orientations, ocrlang,
+                                                callback)
+            img = dict(orientations)[rotation]
 
-        # Save the boxes
-        with open(boxfile, 'w') as file_desc:
-            pyocr.builders.WordBoxBuilder().write_file(file_desc, boxes)
+        print "Saving scan in '%s'" % (self.__img_path)
+        img.save(self.__img_path)
+        self._save_ocr_result(txt, boxes)
 
-        # delete temporary files
-        for outfile in outfiles:
-            os.unlink(outfile)
+        self.doc.drop_cache()
 
         print "Scan done"
 
@@ -453,18 +464,9 @@ class ImgPage(BasicPage):
         """
         print "Redoing OCR of '%s'" % (str(self))
 
-        imgfile = self.__img_path
-        txtfile = self.__txt_path
-        boxfile = self.__box_path
-
-        (imgfile, txt, boxes) = self.__ocr([imgfile], ocrlang,
-                                           dummy_progress_cb)
-        # save the text
-        with open(txtfile, 'w') as file_desc:
-            file_desc.write(txt)
-        # save the boxes
-        with open(boxfile, 'w') as file_desc:
-            pyocr.builders.WordBoxBuilder.write_file(file_desc, boxes)
+        (_, txt, boxes) = self.__ocr([(None, self.img)], ocrlang,
+                                     dummy_progress_cb)
+        self._save_ocr_result(txt, boxes)
 
     def __ch_number(self, offset):
         """
@@ -488,6 +490,10 @@ class ImgPage(BasicPage):
         for key in src.keys():
             if os.access(src[key], os.F_OK):
                 os.rename(src[key], dst[key])
+        self.doc.drop_cache()
+        # the renamed files may keep the same modification time: the
+        # thumbnail cached for the previous number can't be told apart
+        get_thumbnail_cache().remove(self.doc.path, self.page_nb - offset)
 
     def destroy(self):
         """
@@ -505,6 +511,8 @@ class ImgPage(BasicPage):
             os.unlink(self.__get_box_path())
         if os.access(self.__get_img_path(), os.F_OK):
             os.unlink(self.__get_img_path())
+        self.doc.drop_cache()
+        get_thumbnail_cache().remove(self.doc.path, self.page_nb)
         for page_nb in range(self.page_nb + 1, current_doc_nb_pages):
             page = self.doc.pages[page_nb]
             page.__ch_number(-1)
@@ -18,9 +18,34 @@
 Code to manage document labels
 """
 
-import gtk
+import threading
 
-from paperwork.util import load_uifile
+
+def _parse_color(color):
+    """
+    Parse a color string in the '#rgb', '#rrggbb', '#rrrgggbbb' or
+    '#rrrrggggbbbb' notations (the ones accepted by gtk.gdk.color_parse()).
+
+    Returns:
+        A tuple (red, green, blue). Each component is in the range 0-65535.
+    """
+    color = color.strip()
+    digits = color[1:]
+    if (color[:1] != "#" or len(digits) not in (3, 6, 9, 12)):
+        raise ValueError("Invalid color: %s" % color)
+    length = len(digits) / 3
+    components = []
+    for idx in range(0, 3):
+        value = int(digits[idx * length:(idx + 1) * length], 16)
+        # scale the value to 16 bits the same way GTK does: by repeating
+        # the bits of the component
+        bits = length * 4
+        value <<= (16 - bits)
+        while bits < 16:
+            value |= (value >> bits)
+            bits *= 2
+        components.append(value)
+    return tuple(components)
 
 
 class Label(object):
@@ -35,7 +60,25 @@ class Label(object):
             color --- label color (string representation, see get_color_str())
         """
         self.name = unicode(name)
-        self.color = gtk.gdk.color_parse(color)
+        self.color = color
+
+    def __get_color(self):
+        return self.__color
+
+    def __set_color(self, color):
+        """
+        Arguments:
+            color --- color string (see _parse_color()). Stored in the
+                format returned by get_color_str()
+        """
+        try:
+            components = _parse_color(color)
+        except ValueError, exc:
+            print "Warning: %s. Using black instead" % str(exc)
+            components = (0, 0, 0)
+        self.__color = ("#%04x%04x%04x" % components)
+
+    color = property(__get_color, __set_color)
 
     def __copy__(self):
         return Label(self.name, self.get_color_str())
@@ -69,18 +112,22 @@ class Label(object):
     def __ne__(self, other):
         return self.__label_cmp(other) != 0
 
+    def __hash__(self):
+        return hash((self.name, self.__color))
+
     def get_html_color(self):
         """
         get a string representing the color, using HTML notation
         """
-        return ("#%02X%02X%02X" % (self.color.red >> 8, self.color.green >> 8,
-                                   self.color.blue >> 8))
+        color = self.__color
+        return ("#%s%s%s" % (color[1:3], color[5:7], color[9:11])).upper()
 
     def get_color_str(self):
         """
-        Returns a string representation of the color associated to this label.
+        Returns a string representation of the color associated to this label
+        ('#rrrrggggbbbb', like gtk.gdk.Color.to_string())
         """
-        return self.color.to_string()
+        return self.__color
 
     def get_html(self):
         """
@@ -95,45 +142,44 @@ class Label(object):
                    self.name.encode('ascii', 'replace')))
 
 
-class LabelEditor(object):
+class LabelTable(object):
     """
-    Dialog to create / edit labels
+    Table of all the labels seen in the work directory. Documents sharing
+    a label share the same Label object, so labels are parsed only once.
+
+    Labels returned by this table are shared: they must not be modified.
+    Use copy() to get a label that can be edited.
     """
 
-    def __init__(self, label_to_edit=None):
-        if label_to_edit == None:
-            label_to_edit = Label()
-        self.label = label_to_edit
+    def __init__(self):
+        self.__labels = {}
+        self.__lock = threading.Lock()
 
-    def edit(self, main_window):
+    def get_label(self, name, color):
         """
-        Open the edit dialog, and update the label according to user changes
+        Returns:
+            The labels.Label object corresponding to this name and color
         """
-        widget_tree = load_uifile("labeledit.glade")
-
-        dialog = widget_tree.get_object("dialogLabelEditor")
-        name_entry = widget_tree.get_object("entryLabelName")
-        color_chooser = widget_tree.get_object("colorselectionLabelColor")
-
-        name_entry.set_text(self.label.name)
-        color_chooser.set_current_color(self.label.color)
+        key = (unicode(name), color)
+        with self.__lock:
+            label = self.__labels.get(key)
+            if label is None:
+                label = Label(name, color)
+                self.__labels[key] = label
+        return label
+
+    def parse_line(self, line):
+        """
+        Parse a line of a label file ('name,color')
 
-        dialog.set_transient_for(main_window)
-        dialog.add_button("Cancel", gtk.RESPONSE_CANCEL)
-        dialog.add_button("Ok", gtk.RESPONSE_OK)
-        response = dialog.run()
+        Returns:
+            The matching labels.Label object
+        """
+        (label_name, label_color) = line.strip().split(",")
+        return self.get_label(label_name, label_color)
 
-        if (response == gtk.RESPONSE_OK
-            and name_entry.get_text().strip() == ""):
-            response = gtk.RESPONSE_CANCEL
-        if (response == gtk.RESPONSE_OK):
-            print "Label validated"
-            self.label.name = unicode(name_entry.get_text())
-            self.label.color = color_chooser.get_current_color()
-        else:
-            print "Label editing cancelled"
+    def __len__(self):
+        return len(self.__labels)
 
-        dialog.destroy()
 
-        print "Label after editing: %s" % (self.label)
-        return (response == gtk.RESPONSE_OK)
+LABEL_TABLE = LabelTable()
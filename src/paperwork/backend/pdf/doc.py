@@ -73,6 +73,11 @@ class PdfDoc(BasicDoc):
         self.pages = [PdfPage(self, page_idx) \
                       for page_idx in range(0, self.pdf.get_n_pages())]
 
+    def __get_pdf_path(self):
+        return os.path.join(self.path, PDF_FILENAME)
+
+    pdf_path = property(__get_pdf_path)
+
     def __get_nb_pages(self):
         return len(self.pages)
 
@@ -20,7 +20,9 @@ import os
 import pyocr.builders
 import pyocr.pyocr
 
+from paperwork.backend.common.ocr import get_ocr_pool
 from paperwork.backend.common.page import BasicPage
+from paperwork.util import LRUCache
 from paperwork.util import surface2image
 
 
@@ -28,12 +30,24 @@ class PdfPage(BasicPage):
     FILE_PREFIX = "paper."
     EXT_TXT = "txt"
     EXT_BOX = "words"
+    # Pages are rendered at this factor of their size in points when the
+    # full resolution image is requested
+    RENDERING_FACTOR = 2
+
+    # Last full resolution renderings of PDF pages (see img), keyed by (pdf
+    # path, page number). Renderings at other factors (thumbnails, reduced
+    # images) are not kept: they would evict the ones the page view needs.
+    # Shared by all the PDF documents so the memory used remains bounded
+    # whatever the number of documents opened (a A4 page rendered at
+    # RENDERING_FACTOR takes about 6MB)
+    __renderings = LRUCache(4)
 
     def __init__(self, doc, page_nb):
         BasicPage.__init__(self, doc, page_nb)
         self.pdf_page = doc.pdf.get_page(page_nb)
         size = self.pdf_page.get_size()
         self.size = (int(size[0]), int(size[1]))
+        self.__text = None
 
     def __get_filepath(self, ext):
         """
@@ -48,24 +62,47 @@ class PdfPage(BasicPage):
     def __get_box_path(self):
         return self.__get_filepath(self.EXT_BOX)
 
-    def __get_text(self):
+    def __read_text(self):
+        """
+        Returns:
+            The lines of the text file of this page, or None if there is no
+            such file
+        """
         txtfile = self.__get_txt_path()
-
+        txt = []
         try:
-            os.stat(txtfile)
-
-            txt = []
-            try:
-                with codecs.open(txtfile, 'r', encoding='utf-8') as file_desc:
-                    for line in file_desc.readlines():
-                        line = line.strip()
-                        txt.append(line)
-            except IOError, exc:
+            with codecs.open(txtfile, 'r', encoding='utf-8') as file_desc:
+                for line in file_desc.readlines():
+                    line = line.strip()
+                    txt.append(line)
+        except IOError, exc:
+            if os.path.exists(txtfile):
                 print "Unable to read [%s]: %s" % (txtfile, str(exc))
-            return txt
+                return txt
+            return None
+        return txt
 
-        except OSError, exc:  # os.stat() failed
-            return unicode(self.pdf_page.get_text()).split(u"\n")
+    def __extract_text(self):
+        """
+        Get the text from the PDF itself, and keep it in the text file of
+        the page, so poppler doesn't have to be asked again
+        """
+        txt = unicode(self.pdf_page.get_text())
+        txtfile = self.__get_txt_path()
+        try:
+            with codecs.open(txtfile, 'w', encoding='utf-8') as file_desc:
+                file_desc.write(txt)
+        except IOError, exc:
+            print "Warning: Unable to write [%s]: %s" % (txtfile, str(exc))
+        return [line.strip() for line in txt.split(u"\n")]
+
+    def __get_text(self):
+        if self.__text is None:
+            txt = self.__read_text()
+            if txt is None:
+                txt = self.__extract_text()
+            self.__text = txt
+        return self.__text
 
     text = property(__get_text)
 
@@ -95,7 +132,17 @@ class PdfPage(BasicPage):
 
     boxes = property(__get_boxes)
 
+    def _get_boxes_cache_key(self):
+        boxfile = self.__get_box_path()
+        try:
+            return (boxfile, os.path.getmtime(boxfile))
+        except OSError:
+            return None
+
     def __render_img(self, factor):
+        """
+        Render the page at the given factor of its size in points
+        """
         # TODO(Jflesch): In a perfect world, we shouldn't use ImageSurface.
         # we should draw directly on the GtkImage.window.cairo_create() context.
         # It would be much more efficient.
@@ -110,14 +157,59 @@ class PdfPage(BasicPage):
         return surface2image(surface)
 
     def __get_img(self):
-        return self.__render_img(2)
+        """
+        Render the page at RENDERING_FACTOR. The last renderings are kept in
+        memory: the caller gets its own copy of the image.
+        """
+        key = (self.doc.pdf_path, self.page_nb)
+        img = self.__renderings.get(key)
+        if img is None:
+            img = self.__render_img(self.RENDERING_FACTOR)
+            self.__renderings.put(key, img)
+        return img.copy()
 
     img = property(__get_img)
 
-    def get_thumbnail(self, width):
+    def get_image(self, max_width=None):
+        """
+        See BasicPage.get_image(). The page is rendered directly at the
+        wanted width.
+        """
+        if max_width is None:
+            return self.img
+        factor = float(max_width) / self.size[0]
+        if factor >= self.RENDERING_FACTOR:
+            return self.img
+        return self.__render_img(factor)
+
+    def get_image_size(self):
+        return (int(self.RENDERING_FACTOR * self.size[0]),
+                int(self.RENDERING_FACTOR * self.size[1]))
+
+    def get_tile(self, factor, area):
+        """
+        See BasicPage.get_tile(). Only the requested part of the page is
+        rendered, directly at the wanted scale.
+        """
+        (x, y, width, height) = area
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        ctx.translate(-x, -y)
+        ctx.scale(factor * self.RENDERING_FACTOR,
+                  factor * self.RENDERING_FACTOR)
+        self.pdf_page.render(ctx)
+        return surface2image(surface)
+
+    def _make_thumbnail(self, width):
         factor = float(width) / self.size[0]
         return self.__render_img(factor)
 
+    def _get_thumbnail_source_mtime(self):
+        try:
+            return os.path.getmtime(self.doc.pdf_path)
+        except OSError:
+            return None
+
     def print_page_cb(self, print_op, print_context):
         ctx = print_context.get_cairo_context()
 
@@ -138,24 +230,27 @@ class PdfPage(BasicPage):
         return None
 
     def redo_ocr(self, ocrlang):
-        img = self.img
-        txtfile = self.__get_txt_path()
-        boxfile = self.__get_box_path()
-
         ocr_tools = pyocr.pyocr.get_available_tools()
         if len(ocr_tools) <= 0:
             # shouldn't happen: scan buttons should be disabled
             # in that case
             raise Exception("No OCR tool available")
 
-        txt = ocr_tools[0].image_to_string(img, lang=ocrlang)
-        boxes = ocr_tools[0].image_to_string(img, lang=ocrlang,
-                                             builder=pyocr.builders.WordBoxBuilder())
+        (_, txt, boxes) = get_ocr_pool().ocr(self.img, ocrlang)
+        self._save_ocr_result(txt, boxes)
+
+    def _save_ocr_result(self, txt, boxes):
+        """
+        See BasicPage._save_ocr_result()
+        """
+        txtfile = self.__get_txt_path()
+        boxfile = self.__get_box_path()
 
         # save the text
-        with open(txtfile, 'w') as file_desc:
+        with codecs.open(txtfile, 'w', encoding='utf-8') as file_desc:
             file_desc.write(txt)
+        self.__text = None
         # save the boxes
-        with open(boxfile, 'w') as file_desc:
-            pyocr.builders.WordBoxBuilder.write_file(file_desc, boxes)
+        with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
+            pyocr.builders.WordBoxBuilder().write_file(file_desc, boxes)
 
@@ -0,0 +1,69 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Dialog to create and edit document labels
+"""
+
+import gtk
+
+from paperwork.backend.labels import Label
+from paperwork.util import load_uifile
+
+
+class LabelEditor(object):
+    """
+    Dialog to create / edit labels
+    """
+
+    def __init__(self, label_to_edit=None):
+        if label_to_edit == None:
+            label_to_edit = Label()
+        self.label = label_to_edit
+
+    def edit(self, main_window):
+        """
+        Open the edit dialog, and update the label according to user changes
+        """
+        widget_tree = load_uifile("labeledit.glade")
+
+        dialog = widget_tree.get_object("dialogLabelEditor")
+        name_entry = widget_tree.get_object("entryLabelName")
+        color_chooser = widget_tree.get_object("colorselectionLabelColor")
+
+        name_entry.set_text(self.label.name)
+        color_chooser.set_current_color(
+            gtk.gdk.color_parse(self.label.get_color_str()))
+
+        dialog.set_transient_for(main_window)
+        dialog.add_button("Cancel", gtk.RESPONSE_CANCEL)
+        dialog.add_button("Ok", gtk.RESPONSE_OK)
+        response = dialog.run()
+
+        if (response == gtk.RESPONSE_OK
+            and name_entry.get_text().strip() == ""):
+            response = gtk.RESPONSE_CANCEL
+        if (response == gtk.RESPONSE_OK):
+            print "Label validated"
+            self.label.name = unicode(name_entry.get_text())
+            self.label.color = color_chooser.get_current_color().to_string()
+        else:
+            print "Label editing cancelled"
+
+        dialog.destroy()
+
+        print "Label after editing: %s" % (self.label)
+        return (response == gtk.RESPONSE_OK)
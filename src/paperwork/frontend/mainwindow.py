@@ -15,7 +15,10 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 from copy import copy
+import math
+import multiprocessing
 import os
 import sys
 import threading
@@ -31,6 +34,7 @@ import pyinsane.rawapi
 
 from paperwork.frontend.aboutdialog import AboutDialog
 from paperwork.frontend.actions import SimpleAction
+from paperwork.frontend.labeleditor import LabelEditor
 from paperwork.frontend.multiscan import MultiscanDialog
 from paperwork.frontend.settingswindow import SettingsWindow
 from paperwork.frontend.workers import Worker
@@ -41,11 +45,12 @@ from paperwork.backend.docsearch import DocSearch
 from paperwork.backend.docsearch import DummyDocSearch
 from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.img.page import ImgPage
-from paperwork.backend.labels import LabelEditor
 from paperwork.util import add_img_border
 from paperwork.util import ask_confirmation
+from paperwork.util import BoxGrid
 from paperwork.util import image2pixbuf
 from paperwork.util import load_uifile
+from paperwork.util import LRUCache
 from paperwork.util import popup_no_scanner_found
 from paperwork.util import sizeof_fmt
 
@@ -67,6 +72,125 @@ def check_workdir(config):
     os.mkdir(config.workdir, 0755)
 
 
+THUMBNAIL_WIDTH = 150
+
+# The page image is displayed by tiles of this size (pixels)
+PAGE_TILE_SIZE = 256
+# Number of page tiles kept in memory
+PAGE_TILE_CACHE_SIZE = 128
+
+# A thumbnail not done after this time (in seconds) is considered as lost:
+# a worker of the thumbnail pool that dies takes its job with it
+THUMBNAIL_TIMEOUT = 60
+# Interval (in seconds) at which _make_thumbnails() checks if it must stop
+# while waiting for a thumbnail
+THUMBNAIL_POLL_INTERVAL = 0.2
+
+__THUMBNAIL_POOL = None
+__THUMBNAIL_POOL_LOCK = threading.Lock()
+
+
+def _get_thumbnail_pool():
+    """
+    Returns the pool of processes generating the thumbnails. It's started
+    the first time it is needed, and then kept until Paperwork exits.
+    """
+    global __THUMBNAIL_POOL
+    with __THUMBNAIL_POOL_LOCK:
+        if __THUMBNAIL_POOL is None:
+            __THUMBNAIL_POOL = multiprocessing.Pool()
+        return __THUMBNAIL_POOL
+
+
+def _replace_thumbnail_pool(pool):
+    """
+    Stop a thumbnail pool that lost a job. A new one is started the next
+    time the pool is needed (see _get_thumbnail_pool()). Nothing is done if
+    the pool has already been replaced.
+    """
+    global __THUMBNAIL_POOL
+    with __THUMBNAIL_POOL_LOCK:
+        if __THUMBNAIL_POOL is not pool:
+            return
+        __THUMBNAIL_POOL = None
+    pool.terminate()
+
+
+def _make_thumbnail(job):
+    """
+    Run in the thumbnail pool: get the thumbnail of a page and add its border.
+
+    Arguments:
+        job --- tuple (document path, document id, page number)
+
+    Returns:
+        A tuple (size, raw RGB data)
+    """
+    (docpath, docid, page_nb) = job
+    doc = DocSearch.get_doc(docpath, docid)
+    img = doc.pages[page_nb].get_thumbnail(THUMBNAIL_WIDTH)
+    img = add_img_border(img.convert("RGB"))
+    return (img.size, img.tostring())
+
+
+def _make_thumbnails(worker, jobs):
+    """
+    Generate thumbnails using the thumbnail pool. Only a few of them are
+    requested to the pool at once, so we can stop quickly.
+
+    If a thumbnail is not done after THUMBNAIL_TIMEOUT, it is skipped and the
+    pool is replaced: the other thumbnails requested are sent again to the
+    new one.
+
+    Arguments:
+        worker --- stop as soon as worker.can_run is False. Thumbnails still
+            being generated are then dropped
+        jobs --- list of tuples (index, doc, page number)
+
+    Returns:
+        A generator of tuples (index, pixbuf), in the order of the jobs
+    """
+    pool = _get_thumbnail_pool()
+    max_pending = 2 * multiprocessing.cpu_count()
+    # (index, job, deadline, AsyncResult)
+    pending = collections.deque()
+    jobs = iter(jobs)
+    while True:
+        while len(pending) < max_pending and worker.can_run:
+            try:
+                (idx, doc, page_nb) = jobs.next()
+            except StopIteration:
+                break
+            job = (doc.path, doc.docid, page_nb)
+            pending.append((idx, job, time.time() + THUMBNAIL_TIMEOUT,
+                            pool.apply_async(_make_thumbnail, [job])))
+        if len(pending) <= 0 or not worker.can_run:
+            return
+        (idx, job, deadline, result) = pending[0]
+        result.wait(THUMBNAIL_POLL_INTERVAL)
+        if not result.ready():
+            if time.time() >= deadline:
+                print "Warning: Thumbnail %d timed out" % idx
+                pending.popleft()
+                _replace_thumbnail_pool(pool)
+            current_pool = _get_thumbnail_pool()
+            if current_pool is not pool:
+                # the jobs of the previous pool are lost
+                pool = current_pool
+                pending = collections.deque([
+                    (idx, job, time.time() + THUMBNAIL_TIMEOUT,
+                     pool.apply_async(_make_thumbnail, [job]))
+                    for (idx, job, _, _) in pending])
+            continue
+        pending.popleft()
+        try:
+            (size, data) = result.get()
+        except Exception, exc:
+            print "Warning: Unable to make thumbnail %d: %s" % (idx, str(exc))
+            continue
+        yield (idx, image2pixbuf(Image.fromstring("RGB", size, data)))
+
+
 def check_scanner(main_win, config):
     if config.scanner_devid != None:
         return True
@@ -114,8 +238,14 @@ class WorkerDocIndexer(Worker):
     def do(self):
         self.emit('indexation-start')
         try:
-            docsearch = DocSearch(self.__config.workdir, self.__progress_cb)
-            self.__main_win.docsearch = docsearch
+            docsearch = self.__main_win.docsearch
+            if (isinstance(docsearch, DocSearch)
+                and docsearch.rootdir == self.__config.workdir):
+                docsearch.reindex(self.__progress_cb)
+            else:
+                docsearch = DocSearch(self.__config.workdir,
+                                      self.__progress_cb)
+                self.__main_win.docsearch = docsearch
         except StopIteration:
             print "Indexation interrupted"
         self.emit('indexation-end')
@@ -144,16 +274,20 @@ class WorkerPageThumbnailer(Worker):
         Worker.__init__(self, "Page thumbnailing")
         self.__main_win = main_window
 
-    def do(self):
+    def do(self, page_indexes=None):
+        """
+        Arguments:
+            page_indexes --- pages to thumbnail, in this order. All the pages
+                of the current document if None
+        """
         self.emit('page-thumbnailing-start')
-        for page_idx in range(0, self.__main_win.doc.nb_pages):
-            page = self.__main_win.doc.pages[page_idx]
-            img = page.get_thumbnail(150)
-            img = add_img_border(img)
-            pixbuf = image2pixbuf(img)
+        doc = self.__main_win.doc
+        if page_indexes is None:
+            page_indexes = range(0, doc.nb_pages)
+        jobs = [(page_idx, doc, page_idx) for page_idx in page_indexes]
+        for (page_idx, pixbuf) in _make_thumbnails(self, jobs):
             if not self.can_run:
-                self.emit('page-thumbnailing-end')
-                return
+                break
             self.emit('page-thumbnailing-page-done', page_idx, pixbuf)
         self.emit('page-thumbnailing-end')
 
@@ -183,22 +317,22 @@ class WorkerDocThumbnailer(Worker):
         self.__main_win = main_window
 
     def do(self, doc_indexes=None):
+        """
+        Arguments:
+            doc_indexes --- documents to thumbnail, in this order. All the
+                documents of the list if None
+        """
         self.emit('doc-thumbnailing-start')
 
         doclist = self.__main_win.lists['matches']['doclist']
         if doc_indexes is None:
             doc_indexes = range(0, len(doclist))
 
-        for doc_idx in doc_indexes:
-            doc = doclist[doc_idx]
-            if doc.nb_pages <= 0:
-                continue
-            img = doc.pages[0].get_thumbnail(150)
-            img = add_img_border(img)
-            pixbuf = image2pixbuf(img)
+        jobs = [(doc_idx, doclist[doc_idx], 0) for doc_idx in doc_indexes
+                if doclist[doc_idx].nb_pages > 0]
+        for (doc_idx, pixbuf) in _make_thumbnails(self, jobs):
             if not self.can_run:
-                self.emit('doc-thumbnailing-end')
-                return
+                break
             self.emit('doc-thumbnailing-doc-done', doc_idx, pixbuf)
         self.emit('doc-thumbnailing-end')
 
@@ -208,57 +342,91 @@ gobject.type_register(WorkerDocThumbnailer)
 
 class WorkerImgBuilder(Worker):
     """
-    Resize and paint on the page
+    Render tiles of the page image at the current zoom level. The tiles to
+    render are given with request(): a new request replaces the previous
+    one, so the main loop never has to wait for the builder to stop.
     """
     __gsignals__ = {
         'img-building-start' :
             (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
-        'img-building-result-pixbuf' :
+        'img-building-result-tile' :
             (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
-             (gobject.TYPE_FLOAT, gobject.TYPE_INT, gobject.TYPE_PYOBJECT, )),
+             # tile key (see MainWindow.get_tile_key()), pixbuf
+             (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT, )),
         'img-building-result-stock' :
             (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
              (gobject.TYPE_STRING, )),
+        'img-building-end' :
+            (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
-    # even if it's not true, this process is not really long, so it doesn't
-    # really matter
     can_interrupt = True
 
     def __init__(self, main_window):
         Worker.__init__(self, "Building page image")
         self.__main_win = main_window
+        self.__lock = threading.Lock()
+        # (page, factor, tiles) not yet taken by the builder thread
+        self.__request = None
+        # True as long as the builder thread may still take a request
+        self.__busy = False
 
-    def do(self):
-        self.emit('img-building-start')
+    def request(self, page, factor, tiles):
+        """
+        Render tiles. The tiles of the previous request not rendered yet are
+        dropped.
 
-        if self.__main_win.page.img == None:
-            self.emit('img-building-result-stock', gtk.STOCK_MISSING_IMAGE)
-            return
+        Arguments:
+            page --- page to render
+            factor --- zoom factor
+            tiles --- list of tuples (x, y, width, height): parts of the
+                zoomed page image to render, in this order
+        """
+        with self.__lock:
+            self.__request = (page, factor, tiles)
+            if self.__busy:
+                return
+            self.__busy = True
+        # if there is still a builder thread, it has nothing left to do and
+        # is ending
+        self.wait()
+        self.start()
 
-        time.sleep(0.25) # to keep the GUI smooth
-        if not self.can_run:
-            self.emit('img-building-result-stock', gtk.STOCK_DIALOG_ERROR)
-            return
+    def cancel(self):
+        """
+        Drop the tiles not rendered yet. Doesn't wait for the tile being
+        rendered.
+        """
+        with self.__lock:
+            if self.__busy:
+                self.__request = (None, 0.0, [])
 
+    def do(self):
+        self.emit('img-building-start')
         try:
-            img = self.__main_win.page.img
-
-            pixbuf = image2pixbuf(img)
-            original_width = pixbuf.get_width()
-
-            factor = self.__main_win.get_zoom_factor(original_width)
-            print "Zoom: %f" % (factor)
-
-            wanted_width = int(factor * pixbuf.get_width())
-            wanted_height = int(factor * pixbuf.get_height())
-            pixbuf = pixbuf.scale_simple(wanted_width, wanted_height,
-                                         gtk.gdk.INTERP_BILINEAR)
-
-            self.emit('img-building-result-pixbuf', factor, original_width, pixbuf)
+            while True:
+                with self.__lock:
+                    if self.__request is None or not self.can_run:
+                        self.__busy = False
+                        return
+                    (page, factor, tiles) = self.__request
+                    self.__request = None
+                for (x, y, width, height) in tiles:
+                    if not self.can_run or self.__request is not None:
+                        break
+                    img = page.get_tile(factor, (x, y, width, height))
+                    self.emit('img-building-result-tile',
+                              self.__main_win.get_tile_key(page, factor,
+                                                           x, y),
+                              image2pixbuf(img))
         except Exception, exc:
+            with self.__lock:
+                self.__request = None
+                self.__busy = False
             self.emit('img-building-result-stock', gtk.STOCK_DIALOG_ERROR)
             raise exc
+        finally:
+            self.emit('img-building-end')
 
 
 gobject.type_register(WorkerImgBuilder)
@@ -346,7 +514,7 @@ class WorkerOCRRedoer(Worker):
         'redo-ocr-end' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
-    can_interrupt = False
+    can_interrupt = True
 
     def __init__(self, main_window, config):
         Worker.__init__(self, "Redoing OCR")
@@ -360,7 +528,8 @@ class WorkerOCRRedoer(Worker):
     def do(self, doc_target):
         self.emit('redo-ocr-start')
         try:
-            doc_target.redo_ocr(self.__config.ocrlang, self.__progress_cb)
+            doc_target.redo_ocr(self.__config.ocrlang, self.__progress_cb,
+                                lambda: self.can_run)
         finally:
             self.emit('redo-ocr-end')
 
@@ -660,8 +829,7 @@ class ActionRebuildPage(SimpleAction):
 
     def do(self):
         SimpleAction.do(self)
-        self.__main_win.workers['img_builder'].stop()
-        self.__main_win.workers['img_builder'].start()
+        self.__main_win.refresh_page_img()
 
 
 class ActionLabelSelected(SimpleAction):
@@ -685,13 +853,15 @@ class ActionToggleLabel(object):
             print ("Action: Adding label '%s' on document '%s'"
                    % (str(label), str(self.__main_win.doc)))
             self.__main_win.doc.add_label(label)
+            self.__main_win.docsearch.add_label(label, self.__main_win.doc)
         else:
             print ("Action: Removing label '%s' on document '%s'"
                    % (str(label), str(self.__main_win.doc)))
             self.__main_win.doc.remove_label(label)
+            self.__main_win.docsearch.remove_label(label,
+                                                   self.__main_win.doc)
         self.__main_win.refresh_label_list()
         self.__main_win.refresh_docs([self.__main_win.doc])
-        # TODO(Jflesch): Update keyword index
 
     def connect(self, cellrenderers):
         for cellrenderer in cellrenderers:
@@ -1289,6 +1459,8 @@ class MainWindow(object):
 
         self.window = widget_tree.get_object("mainWindow")
         self.__win_size_cache = None
+        # see get_tile_key() -> pixbuf
+        self.__tile_cache = LRUCache(PAGE_TILE_CACHE_SIZE)
 
         self.__config = config
         self.__scan_start = 0.0
@@ -1350,13 +1522,22 @@ class MainWindow(object):
             "image" : widget_tree.get_object("imagePageImg"),
             "scrollbar" : widget_tree.get_object("scrolledwindowPageImg"),
             "eventbox" : widget_tree.get_object("eventboxImg"),
-            "pixbuf" : None,
+            # displays the page image, in place of "image" (see
+            # __show_img_widget())
+            "page_area" : gtk.DrawingArea(),
             "factor" : 1.0,
             "original_width" : 1,
+            # size of the zoomed page image
+            "size" : (1, 1),
+            # None if the page image is not displayed. Otherwise:
+            # { 'page' : ..., 'factor' : ...,
+            #   'requested' : set of (x, y) }
+            "tiles" : None,
             "boxes" : {
                 "can_draw" : True,
                 "highlighted" : [],
                 "all" : [],
+                "grid" : BoxGrid([]),
                 "current" : None,
             }
         }
@@ -1756,6 +1937,14 @@ class MainWindow(object):
         self.img['eventbox'].add_events(gtk.gdk.POINTER_MOTION_MASK)
         self.img['eventbox'].connect("motion-notify-event",
                                      self.__on_img_mouse_motion)
+        self.img['page_area'].connect("expose-event",
+                                      self.__on_page_area_expose)
+        for adjustment in [self.img['scrollbar'].get_hadjustment(),
+                           self.img['scrollbar'].get_vadjustment()]:
+            adjustment.connect("value-changed",
+                               lambda adj: self.__render_visible_tiles())
+            adjustment.connect("changed",
+                               lambda adj: self.__render_visible_tiles())
 
         self.window.connect("destroy",
                             ActionRealQuit(self, config).on_window_close_cb)
@@ -1798,13 +1987,16 @@ class MainWindow(object):
         self.workers['img_builder'].connect('img-building-start',
                 lambda builder: \
                     gobject.idle_add(self.__on_img_building_start))
-        self.workers['img_builder'].connect('img-building-result-pixbuf',
-                lambda builder, factor, original_width, img: \
-                    gobject.idle_add(self.__on_img_building_result_pixbuf,
-                                     builder, factor, original_width, img))
+        self.workers['img_builder'].connect('img-building-result-tile',
+                lambda builder, tile_key, pixbuf: \
+                    gobject.idle_add(self.__on_img_building_result_tile,
+                                     tile_key, pixbuf))
         self.workers['img_builder'].connect('img-building-result-stock',
                 lambda builder, img: \
                     gobject.idle_add(self.__on_img_building_result_stock, img))
+        self.workers['img_builder'].connect('img-building-end',
+                lambda builder: \
+                    gobject.idle_add(self.__on_img_building_end))
 
         self.workers['label_updater'].connect('label-updating-start',
                 lambda updater: \
@@ -1949,28 +2141,29 @@ class MainWindow(object):
 
     def __on_img_building_start(self):
         self.set_mouse_cursor("Busy")
-        self.img['image'].set_from_stock(gtk.STOCK_EXECUTE, gtk.ICON_SIZE_DIALOG)
 
     def __on_img_building_result_stock(self, img):
-        self.img['image'].set_from_stock(img, gtk.ICON_SIZE_DIALOG)
-        self.set_mouse_cursor("Normal")
-
-    def __on_img_building_result_pixbuf(self, builder, factor, original_width, img):
-        self.img['factor'] = factor
-        self.img['pixbuf'] = img
-        self.img['original_width'] = original_width
-
-        (pixmap, mask) = img.render_pixmap_and_mask()
-
-        show_all = self.show_all_boxes.get_active()
-        if show_all:
-            box_list = self.img['boxes']['all']
-        else:
-            box_list = self.img['boxes']['highlighted']
-        for box in box_list:
-            self.__draw_box(pixmap, box)
-
-        self.img['image'].set_from_pixmap(pixmap, mask)
+        self.__show_img_stock(img)
+
+    def __on_img_building_result_tile(self, tile_key, pixbuf):
+        self.__tile_cache.put(tile_key, pixbuf)
+        tiles = self.img['tiles']
+        if (tiles is None
+                or tile_key != self.get_tile_key(tiles['page'],
+                                                 tiles['factor'],
+                                                 tile_key[-2], tile_key[-1])):
+            # obsolete tile (another page or zoom level is displayed now)
+            return
+        (x, y) = (tile_key[-2], tile_key[-1])
+        tiles['requested'].discard((x, y))
+        (offset_x, offset_y) = self.__get_page_area_offset()
+        self.img['page_area'].queue_draw_area(offset_x + x, offset_y + y,
+                                              pixbuf.get_width(),
+                                              pixbuf.get_height())
+
+    def __on_img_building_end(self):
+        if self.img['tiles'] is not None:
+            self.img['tiles']['requested'] = set()
         self.set_mouse_cursor("Normal")
 
     def __on_window_resize_cb(self, window, allocation):
@@ -2019,7 +2212,7 @@ class MainWindow(object):
     def __on_single_scan_start(self, src):
         self.set_progression(src, 0.0, _("Scanning ..."))
         self.set_mouse_cursor("Busy")
-        self.img['image'].set_from_stock(gtk.STOCK_EXECUTE, gtk.ICON_SIZE_DIALOG)
+        self.__show_img_stock(gtk.STOCK_EXECUTE)
         for widget in self.doc_edit_widgets:
             widget.set_sensitive(False)
         self.__scan_start = time.time()
@@ -2060,7 +2253,7 @@ class MainWindow(object):
     def __on_import_start(self, src):
         self.set_progression(src, 0.0, _("Importing ..."))
         self.set_mouse_cursor("Busy")
-        self.img['image'].set_from_stock(gtk.STOCK_EXECUTE, gtk.ICON_SIZE_DIALOG)
+        self.__show_img_stock(gtk.STOCK_EXECUTE)
         self.workers['progress_updater'].start(
             value_min=0.0, value_max=1.0,
             total_time=self.__config.scan_time['ocr'])
@@ -2091,28 +2284,31 @@ class MainWindow(object):
             return
         popup_menu.popup(None, None, None, event.button, event.time)
 
-    def __get_box_position(self, box, window=None, width=1):
+    def __get_box_position(self, box, width=1):
+        """
+        Returns the position of a box on the zoomed page image
+        """
         ((a, b), (c, d)) = box.position
         a *= self.img['factor']
         b *= self.img['factor']
         c *= self.img['factor']
         d *= self.img['factor']
-        if window:
-            (win_w, win_h) = window.get_size()
-            (pic_w, pic_h) = (self.img['pixbuf'].get_width(),
-                              self.img['pixbuf'].get_height())
-            (margin_x, margin_y) = ((win_w-pic_w)/2, (win_h-pic_h)/2)
-            a += margin_x
-            b += margin_y
-            c += margin_x
-            d += margin_y
         a -= width
         b -= width
         c += width
         d += width
         return ((int(a), int(b)), (int(c), int(d)))
 
-    def __draw_box(self, drawable, box):
+    def __draw_box(self, window, box, offset):
+        """
+        Draw a box on the page drawing area
+
+        Arguments:
+            window --- gdk window of the page drawing area
+            box --- box to draw
+            offset --- position of the page image in the drawing area (see
+                __get_page_area_offset())
+        """
         highlighted = (box in self.img['boxes']['highlighted'])
         width=1
         color='#6c5dd1'
@@ -2120,38 +2316,233 @@ class MainWindow(object):
             width=3
             color='#009f00'
         ((img_a, img_b), (img_c, img_d)) = \
-                self.__get_box_position(box, window=drawable, width=0)
-        cm = drawable.get_colormap()
-        gc = drawable.new_gc(foreground=cm.alloc_color(color))
+                self.__get_box_position(box, width=0)
+        (offset_x, offset_y) = offset
+        cm = window.get_colormap()
+        gc = window.new_gc(foreground=cm.alloc_color(color))
         for i in range(0, width):
-            drawable.draw_rectangle(gc, False,
-                                    x=img_a-i, y=img_b-i,
-                                    width=(img_c-img_a+(2*i)),
-                                    height=(img_d-img_b+(2*i)))
+            window.draw_rectangle(gc, False,
+                                  x=offset_x+img_a-i, y=offset_y+img_b-i,
+                                  width=(img_c-img_a+(2*i)),
+                                  height=(img_d-img_b+(2*i)))
 
-    def __undraw_box(self, drawable, box):
-        ((img_a, img_b), (img_c, img_d)) = \
-                self.__get_box_position(box, window=drawable, width=5)
-        ((pic_a, pic_b), (pic_c, pic_d)) = \
-                self.__get_box_position(box, window=None, width=5)
-        gc = drawable.new_gc()
-        drawable.draw_pixbuf(gc, self.img['pixbuf'],
-                             src_x=pic_a, src_y=pic_b,
-                             dest_x=img_a, dest_y=img_b,
-                             width=(img_c-img_a),
-                             height=(img_d-img_b))
-
-        show_all = self.show_all_boxes.get_active()
-        highlighted = (box in self.img['boxes']['highlighted'])
-        if show_all or highlighted:
-            # force redrawing
-            self.__draw_box(drawable, box)
+    def __get_boxes_to_draw(self):
+        """
+        Returns the boxes that must be drawn on the page image
+        """
+        if self.show_all_boxes.get_active():
+            boxes = self.img['boxes']['all'][:]
+        else:
+            boxes = self.img['boxes']['highlighted'][:]
+        if self.img['boxes']['current'] is not None:
+            boxes.append(self.img['boxes']['current'])
+        return boxes
 
-    def __on_img_mouse_motion(self, event_box, event):
+    def __redraw_box(self, box):
+        """
+        Draw again the page image under a box (and the box itself if it
+        must still be drawn)
+        """
+        if self.img['tiles'] is None:
+            return
+        ((a, b), (c, d)) = self.__get_box_position(box, width=5)
+        (offset_x, offset_y) = self.__get_page_area_offset()
+        self.img['page_area'].queue_draw_area(offset_x + a, offset_y + b,
+                                              c - a, d - b)
+
+    def get_tile_key(self, page, factor, x, y):
+        """
+        Returns the key of a tile of the page image in the tile cache
+        """
+        return (page.doc.docid, page.page_nb, factor, x, y)
+
+    def __get_visible_tiles(self):
+        """
+        Returns the tiles of the page image currently visible (and the ones
+        around them), as tuples (x, y, width, height). The ones in the middle
+        of the visible area come first.
+        """
+        (width, height) = self.img['size']
+        allocation = self.img['scrollbar'].get_allocation()
+        area = []
+        for (adjustment, size, allocated) in [
+                (self.img['scrollbar'].get_hadjustment(), width,
+                 allocation.width),
+                (self.img['scrollbar'].get_vadjustment(), height,
+                 allocation.height)]:
+            # the image is centered if it's smaller than the visible area
+            margin = max(0, (adjustment.upper - size) / 2)
+            page_size = adjustment.page_size
+            if page_size <= 0:
+                # not displayed yet
+                page_size = allocated
+            # also prepare the tiles just around the visible area
+            start = adjustment.value - margin - PAGE_TILE_SIZE
+            end = adjustment.value + page_size - margin + PAGE_TILE_SIZE
+            start = max(0, int(start) / PAGE_TILE_SIZE)
+            end = min((size - 1) / PAGE_TILE_SIZE,
+                      int(math.ceil(end)) / PAGE_TILE_SIZE)
+            area.append((start, end))
+        ((first_x, last_x), (first_y, last_y)) = area
+        middle = ((first_x + last_x) / 2.0, (first_y + last_y) / 2.0)
+
+        tiles = []
+        for tile_y in range(first_y, last_y + 1):
+            for tile_x in range(first_x, last_x + 1):
+                tiles.append((tile_x, tile_y))
+        tiles.sort(key=lambda tile: (abs(tile[0] - middle[0])
+                                     + abs(tile[1] - middle[1])))
+        return [(tile_x * PAGE_TILE_SIZE, tile_y * PAGE_TILE_SIZE,
+                 min(PAGE_TILE_SIZE, width - (tile_x * PAGE_TILE_SIZE)),
+                 min(PAGE_TILE_SIZE, height - (tile_y * PAGE_TILE_SIZE)))
+                for (tile_x, tile_y) in tiles]
+
+    def __get_page_area_offset(self):
+        """
+        Returns the position (x, y) of the page image in the page drawing
+        area. The page image is centered if it's smaller than the area.
+        """
+        allocation = self.img['page_area'].get_allocation()
+        (width, height) = self.img['size']
+        return (max(0, (allocation.width - width) / 2),
+                max(0, (allocation.height - height) / 2))
+
+    def __on_page_area_expose(self, drawing_area, event):
+        """
+        Draw the tiles of the page image intersecting the exposed area, and
+        the boxes on them. Only the tiles in the tile cache can be drawn: the
+        missing ones are requested to the image builder, and the area is
+        exposed again when they are ready.
+        """
+        tiles = self.img['tiles']
+        if tiles is None:
+            return True
+        window = drawing_area.window
+        (offset_x, offset_y) = self.__get_page_area_offset()
+        (width, height) = self.img['size']
+        area_a = max(0, event.area.x - offset_x)
+        area_b = max(0, event.area.y - offset_y)
+        area_c = min(width, event.area.x + event.area.width - offset_x)
+        area_d = min(height, event.area.y + event.area.height - offset_y)
+        if area_a >= area_c or area_b >= area_d:
+            return True
+
+        missing = False
+        white_gc = drawing_area.get_style().white_gc
+        # the drawing is clipped to the exposed area
+        for tile_y in range(area_b / PAGE_TILE_SIZE,
+                            (area_d - 1) / PAGE_TILE_SIZE + 1):
+            for tile_x in range(area_a / PAGE_TILE_SIZE,
+                                (area_c - 1) / PAGE_TILE_SIZE + 1):
+                (x, y) = (tile_x * PAGE_TILE_SIZE, tile_y * PAGE_TILE_SIZE)
+                pixbuf = self.__tile_cache.get(
+                    self.get_tile_key(tiles['page'], tiles['factor'], x, y))
+                if pixbuf is None:
+                    missing = True
+                    window.draw_rectangle(white_gc, True,
+                                          offset_x + x, offset_y + y,
+                                          min(PAGE_TILE_SIZE, width - x),
+                                          min(PAGE_TILE_SIZE, height - y))
+                    continue
+                window.draw_pixbuf(None, pixbuf, 0, 0,
+                                   offset_x + x, offset_y + y, -1, -1)
+
+        for box in self.__get_boxes_to_draw():
+            ((a, b), (c, d)) = self.__get_box_position(box, width=5)
+            if a < area_c and c > area_a and b < area_d and d > area_b:
+                self.__draw_box(window, box, (offset_x, offset_y))
+
+        if missing:
+            self.__render_visible_tiles()
+        return True
+
+    def __render_visible_tiles(self):
+        """
+        Request to the image builder the visible tiles of the page image
+        not in the tile cache. They are drawn as soon as they are rendered.
+        """
+        tiles = self.img['tiles']
+        if tiles is None:
+            return
+        missing = []
+        for (x, y, width, height) in self.__get_visible_tiles():
+            tile_key = self.get_tile_key(tiles['page'], tiles['factor'], x, y)
+            if not tile_key in self.__tile_cache:
+                missing.append((x, y, width, height))
+        if len(missing) <= 0:
+            return
+        if tiles['requested'].issuperset([(x, y) for (x, y, _, _) in missing]):
+            return
+        # tiles not yet rendered by the current builder are still missing:
+        # they are requested again. The image builder drops the tiles
+        # requested before and not rendered yet
+        tiles['requested'] = set([(x, y) for (x, y, _, _) in missing])
+        self.workers['img_builder'].request(tiles['page'], tiles['factor'],
+                                            missing)
+
+    def __show_img_widget(self, widget):
+        """
+        Display the given widget in the page image area: either the page
+        drawing area, or the gtk.Image used for the stock icons and the
+        export preview
+        """
+        eventbox = self.img['eventbox']
+        child = eventbox.get_child()
+        if child is widget:
+            return
+        if child is not None:
+            eventbox.remove(child)
+        eventbox.add(widget)
+        widget.show()
+
+    def __show_img_stock(self, stock):
+        """
+        Display a stock icon in place of the page image
+        """
+        self.workers['img_builder'].cancel()
+        self.img['tiles'] = None
+        self.__show_img_widget(self.img['image'])
+        self.img['image'].set_from_stock(stock, gtk.ICON_SIZE_DIALOG)
+
+    def refresh_page_img(self):
+        """
+        Display the current page at the current zoom level. The page image
+        is drawn tile by tile, and only the visible tiles are rendered.
+        """
+        self.img['boxes']['current'] = None
+
+        if isinstance(self.page, DummyPage):
+            self.__show_img_stock(gtk.STOCK_MISSING_IMAGE)
+            return
         try:
-            # make sure we have an image currently displayed
-            self.img['image'].get_pixmap()
-        except ValueError:
+            (original_width, original_height) = self.page.get_image_size()
+        except Exception, exc:
+            print "Unable to get the image of %s: %s" % (str(self.page), exc)
+            self.__show_img_stock(gtk.STOCK_DIALOG_ERROR)
+            return
+
+        factor = self.get_zoom_factor(original_width)
+        print "Zoom: %f" % (factor)
+        size = (max(1, int(factor * original_width)),
+                max(1, int(factor * original_height)))
+
+        self.workers['img_builder'].cancel()
+        self.img['factor'] = factor
+        self.img['original_width'] = original_width
+        self.img['size'] = size
+        self.img['tiles'] = {
+            'page' : self.page,
+            'factor' : factor,
+            'requested' : set(),
+        }
+        self.img['page_area'].set_tooltip_text(None)
+        self.img['page_area'].set_size_request(size[0], size[1])
+        self.__show_img_widget(self.img['page_area'])
+        self.img['page_area'].queue_draw()
+        self.__render_visible_tiles()
+
+    def __on_img_mouse_motion(self, event_box, event):
+        if self.img['tiles'] is None:
             return
 
         if not self.img['boxes']['can_draw']:
@@ -2159,17 +2550,13 @@ class MainWindow(object):
 
         (mouse_x, mouse_y) = event.get_coords()
 
+        # convert the mouse position into a position on the page image
+        (margin_x, margin_y) = self.__get_page_area_offset()
+        img_x = (mouse_x - margin_x) / self.img['factor']
+        img_y = (mouse_y - margin_y) / self.img['factor']
+
         old_box = self.img['boxes']['current']
-        new_box = None
-        for box in self.img['boxes']['all']:
-            ((a, b), (c, d)) = \
-                    self.__get_box_position(box,
-                                            window=self.img['image'].window,
-                                            width=0)
-            if (mouse_x < a or mouse_y < b
-                or mouse_x > c or mouse_y > d):
-                continue
-            new_box = box
+        new_box = self.img['boxes']['grid'].get_box_at(img_x, img_y)
 
         if old_box == new_box:
             return
@@ -2177,11 +2564,11 @@ class MainWindow(object):
         self.img['boxes']['current'] = new_box
 
         if old_box:
-            self.img['image'].set_tooltip_text(None)
-            self.__undraw_box(self.img['image'].window, old_box)
+            self.img['page_area'].set_tooltip_text(None)
+            self.__redraw_box(old_box)
         if new_box:
-            self.img['image'].set_tooltip_text(new_box.content)
-            self.__draw_box(self.img['image'].window, new_box)
+            self.img['page_area'].set_tooltip_text(new_box.content)
+            self.__redraw_box(new_box)
 
     def refresh_suggestions_list(self):
         sentence = unicode(self.search_field.get_text())
@@ -2303,7 +2690,8 @@ class MainWindow(object):
             self.__select_doc(active_idx)
 
         self.workers['doc_thumbnailer'].start(
-            doc_indexes=range(0, max_thumbnail_idx))
+            doc_indexes=self.__get_visible_first(
+                'matches', range(0, max_thumbnail_idx)))
 
     def refresh_docs(self, docs):
         """
@@ -2340,7 +2728,27 @@ class MainWindow(object):
         if active_idx >= 0:
             self.__select_doc(active_idx)
 
-        self.workers['doc_thumbnailer'].start(doc_indexes=doc_indexes)
+        self.workers['doc_thumbnailer'].start(
+            doc_indexes=self.__get_visible_first('matches', doc_indexes))
+
+    def __get_visible_first(self, list_name, indexes):
+        """
+        Sort the given row indexes of a list: rows currently visible first,
+        then the rows the closest to them.
+        """
+        visible = self.lists[list_name]['gui'].get_visible_range()
+        if visible is None:
+            return list(indexes)
+        (first, last) = (visible[0][0], visible[1][0])
+
+        def get_distance(idx):
+            if idx < first:
+                return first - idx
+            if idx > last:
+                return idx - last
+            return 0
+
+        return sorted(indexes, key=get_distance)
 
     def refresh_doc_list(self, docs=[]):
         """
@@ -2380,7 +2788,9 @@ class MainWindow(object):
 
         self.__select_doc(active_idx)
 
-        self.workers['doc_thumbnailer'].start()
+        self.workers['doc_thumbnailer'].start(
+            doc_indexes=self.__get_visible_first(
+                'matches', range(0, len(documents))))
 
     def refresh_page_list(self):
         """
@@ -2388,6 +2798,8 @@ class MainWindow(object):
         Warning: Will remove the thumbnails on all the pages
         """
         self.workers['page_thumbnailer'].stop()
+        # the pages may have been modified
+        self.__tile_cache.clear()
         self.lists['pages']['model'].clear()
         for page in self.doc.pages:
             self.lists['pages']['model'].append([
@@ -2403,7 +2815,9 @@ class MainWindow(object):
             widget.set_sensitive(self.doc.can_edit)
         for widget in self.need_page_widgets:
             widget.set_sensitive(False)
-        self.workers['page_thumbnailer'].start()
+        self.workers['page_thumbnailer'].start(
+            page_indexes=self.__get_visible_first(
+                'pages', range(0, self.doc.nb_pages)))
 
     def refresh_label_list(self):
         """
@@ -2427,15 +2841,13 @@ class MainWindow(object):
         self.img['boxes']['highlighted'] = self.page.get_boxes(search)
 
         for box in old_highlights:
-            self.__undraw_box(self.img['image'].window, box)
+            self.__redraw_box(box)
         for box in self.img['boxes']['highlighted']:
-            self.__draw_box(self.img['image'].window, box)
+            self.__redraw_box(box)
 
     def show_page(self, page):
         print "Showing page %s" % (str(page))
 
-        self.workers['img_builder'].stop()
-
         for widget in self.need_page_widgets:
             widget.set_sensitive(True)
         for widget in self.doc_edit_widgets:
@@ -2459,13 +2871,14 @@ class MainWindow(object):
 
         self.page = page
         self.img['boxes']['all'] = self.page.boxes
+        self.img['boxes']['grid'] = BoxGrid(self.img['boxes']['all'])
         search = unicode(self.search_field.get_text())
         self.img['boxes']['highlighted'] = self.page.get_boxes(search)
 
         self.export['dialog'].set_visible(False)
         self.img['boxes']['can_draw'] = True
 
-        self.workers['img_builder'].start()
+        self.refresh_page_img()
 
     def show_doc(self, doc):
         self.doc = doc
@@ -2478,8 +2891,7 @@ class MainWindow(object):
         if self.doc.nb_pages > 0:
             self.show_page(self.doc.pages[0])
         else:
-            self.img['image'].set_from_stock(gtk.STOCK_MISSING_IMAGE,
-                                             gtk.ICON_SIZE_DIALOG)
+            self.__show_img_stock(gtk.STOCK_MISSING_IMAGE)
 
     def __on_export_preview_start(self):
         self.export['estimated_size'].set_text(_("Computing ..."))
@@ -2487,6 +2899,9 @@ class MainWindow(object):
     def __on_export_preview_done(self, img_size, pixbuf):
         self.export['estimated_size'].set_text(sizeof_fmt(img_size))
         (pixmap, mask) = pixbuf.render_pixmap_and_mask()
+        self.workers['img_builder'].cancel()
+        self.img['tiles'] = None
+        self.__show_img_widget(self.img['image'])
         self.img['image'].set_from_pixmap(pixmap, mask)
         self.img['boxes']['can_draw'] = False
 
@@ -2508,6 +2923,6 @@ class MainWindow(object):
         return float(wanted_width) / pixbuf_width
 
     def refresh_export_preview(self):
-        self.img['image'].set_from_stock(gtk.STOCK_EXECUTE, gtk.ICON_SIZE_DIALOG)
+        self.__show_img_stock(gtk.STOCK_EXECUTE)
         self.workers['export_previewer'].stop()
         self.workers['export_previewer'].start()
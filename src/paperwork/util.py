@@ -18,9 +18,12 @@ Various tiny functions that didn't fit anywhere else.
 """
 
 import array
+import collections
 import os
 import re
 import StringIO
+import sys
+import threading
 import unicodedata
 
 import enchant
@@ -48,43 +51,88 @@ UI_FILES_DIRS = [
 ]
 
 
-def __strip_accents(string):
+class LRUCache(object):
     """
-    Strip all the accents from the string
+    Dictionary keeping only the 'max_size' most recently used elements.
+    Thread-safe.
     """
-    return ''.join(
-        (character for character in unicodedata.normalize('NFD', string)
-         if unicodedata.category(character) != 'Mn'))
 
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.__content = collections.OrderedDict()
+        self.__lock = threading.Lock()
 
-def __cleanup_word_array(keywords):
-    """
-    Yield all the keywords long enough to be used
-    """
-    for word in keywords:
-        if len(word) >= MIN_KEYWORD_LEN:
-            yield word
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__content.pop(key)
+            except KeyError:
+                return default
+            self.__content[key] = value
+            return value
 
+    def put(self, key, value):
+        with self.__lock:
+            self.__content.pop(key, None)
+            self.__content[key] = value
+            while len(self.__content) > self.max_size:
+                self.__content.popitem(last=False)
 
-def split_words(sentence):
+    def remove(self, key):
+        with self.__lock:
+            self.__content.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__content.clear()
+
+    def __contains__(self, key):
+        return key in self.__content
+
+    def __len__(self):
+        return len(self.__content)
+
+
+class _AccentStripTable(dict):
     """
-    Extract and yield the keywords from the sentence:
-    - Drop keywords that are too short
-    - Drop the accents
-    - Make everything lower case
-    - Try to separate the words as much as possible (using 2 list of separators,
-    one being more complete than the others)
+    Table for unicode.translate() that strips all the accents (and make
+    everything lower case). Each character is decomposed (NFD) only the first
+    time it is met, the result is kept in the table.
     """
-    if (sentence == "*"):
-        yield sentence
-        return
 
-    # TODO: i18n
-    sentence = sentence.lower()
-    sentence = __strip_accents(sentence)
+    def __init__(self):
+        dict.__init__(self)
+        # Precompute the most common characters: Basic Latin to Latin
+        # Extended-B
+        for char_code in xrange(0, 0x250):
+            self.__missing__(char_code)
+
+    def __missing__(self, char_code):
+        decomposed = unicodedata.normalize('NFD', unichr(char_code).lower())
+        stripped = u''.join(
+            (character for character in decomposed
+             if unicodedata.category(character) != 'Mn'))
+        self[char_code] = stripped
+        return stripped
 
-    words = FORCED_SPLIT_KEYWORDS_REGEX.split(sentence)
-    for word in __cleanup_word_array(words):
+
+__ACCENT_STRIP_TABLE = _AccentStripTable()
+
+# Short sentences (search queries, word boxes, labels) are split again and
+# again. We keep the most recent ones.
+SPLIT_CACHE_MAX_LEN = 128
+__SPLIT_CACHE = LRUCache(4096)
+
+
+def __split_cleaned_words(sentence):
+    """
+    Extract the keywords from a sentence already in lower case and without
+    accents (see split_words())
+    """
+    keywords = []
+    for word in FORCED_SPLIT_KEYWORDS_REGEX.split(sentence):
+        if len(word) < MIN_KEYWORD_LEN:
+            continue
         can_split = True
         can_yield = False
         subwords = WISHED_SPLIT_KEYWORDS_REGEX.split(word)
@@ -96,12 +144,94 @@ def split_words(sentence):
                 can_split = False
                 break
         if can_split:
-            for subword in subwords:
-                if subword == "":
-                    continue
-                yield subword
+            keywords += [subword for subword in subwords if subword != ""]
         elif can_yield:
-            yield word
+            keywords.append(word)
+    return keywords
+
+
+def split_words(sentence):
+    """
+    Extract and return the keywords from the sentence:
+    - Drop keywords that are too short
+    - Drop the accents
+    - Make everything lower case
+    - Try to separate the words as much as possible (using 2 list of separators,
+    one being more complete than the others)
+
+    Returns:
+        An array of keywords (strings)
+    """
+    if (sentence == "*"):
+        return [sentence]
+
+    if len(sentence) > SPLIT_CACHE_MAX_LEN:
+        return __split_cleaned_words(
+            sentence.translate(__ACCENT_STRIP_TABLE))
+
+    keywords = __SPLIT_CACHE.get(sentence)
+    if keywords is None:
+        # TODO: i18n
+        keywords = tuple(__split_cleaned_words(
+            sentence.translate(__ACCENT_STRIP_TABLE)))
+        __SPLIT_CACHE.put(sentence, keywords)
+    return list(keywords)
+
+
+def split_text(lines):
+    """
+    Extract the keywords from a whole text (for instance, the text of a page)
+    at once. See split_words().
+
+    Arguments:
+        lines --- array of strings
+
+    Returns:
+        An array of keywords (strings)
+    """
+    # words never include spaces, so joining the lines with spaces doesn't
+    # change the result
+    text = u" ".join(lines)
+    return __split_cleaned_words(text.translate(__ACCENT_STRIP_TABLE))
+
+
+class BoxGrid(object):
+    """
+    Spatial index of word boxes (see pyocr boxes): the page is cut in square
+    cells, and each cell knows the boxes overlapping it. Finding the box under
+    a given point only requires looking at the boxes of a single cell.
+    Coordinates are the ones of the page image (not zoomed).
+    """
+
+    CELL_SIZE = 64  # pixels
+
+    def __init__(self, boxes):
+        self.__cells = {}  # (cell x, cell y) -> array of boxes
+        for box in boxes:
+            ((a, b), (c, d)) = box.position
+            for cell_x in xrange(int(a) / self.CELL_SIZE,
+                                 (int(c) / self.CELL_SIZE) + 1):
+                for cell_y in xrange(int(b) / self.CELL_SIZE,
+                                     (int(d) / self.CELL_SIZE) + 1):
+                    cell = (cell_x, cell_y)
+                    if cell in self.__cells:
+                        self.__cells[cell].append(box)
+                    else:
+                        self.__cells[cell] = [box]
+
+    def get_box_at(self, x, y):
+        """
+        Returns the box containing the point (x, y). If many boxes contain it,
+        the last one in the original list is returned. None if there is none.
+        """
+        cell = (int(x) / self.CELL_SIZE, int(y) / self.CELL_SIZE)
+        found = None
+        for box in self.__cells.get(cell, []):
+            ((a, b), (c, d)) = box.position
+            if x < a or y < b or x > c or y > d:
+                continue
+            found = box
+        return found
 
 
 def load_uifile(filename):
@@ -136,14 +266,30 @@ def load_uifile(filename):
     return widget_tree
 
 
+# Layout of the pixels of cairo.FORMAT_RGB24 surfaces (native endian 32 bits
+# words), in PIL raw mode notation
+CAIRO_RGB24_RAW_MODE = ("BGRX" if sys.byteorder == "little" else "XRGB")
+
+
 def image2surface(img):
+    """
+    Convert a PIL image into a cairo surface
+    """
     if img == None:
         return None
-    file_desc = StringIO.StringIO()
-    img.save(file_desc, format="PNG")
-    file_desc.seek(0)
-    surface = cairo.ImageSurface.create_from_png(file_desc)
-    return surface
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        # cairo expects premultiplied alpha: let it convert the image
+        file_desc = StringIO.StringIO()
+        img.save(file_desc, format="PNG")
+        file_desc.seek(0)
+        return cairo.ImageSurface.create_from_png(file_desc)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    # the surface keeps a reference on this buffer
+    data = array.array('B', img.tostring("raw", CAIRO_RGB24_RAW_MODE))
+    return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_RGB24,
+                                              img.size[0], img.size[1],
+                                              img.size[0] * 4)
 
 
 def surface2image(surface):
@@ -167,19 +313,15 @@ def image2pixbuf(img):
     """
     if img == None:
         return None
-    file_desc = StringIO.StringIO()
-    try:
-        img.save(file_desc, "ppm")
-        contents = file_desc.getvalue()
-    finally:
-        file_desc.close()
-    loader = gtk.gdk.PixbufLoader("pnm")
-    try:
-        loader.write(contents, len(contents))
-        pixbuf = loader.get_pixbuf()
-    finally:
-        loader.close()
-    return pixbuf
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    has_alpha = (img.mode == "RGBA")
+    (width, height) = img.size
+    # the pixbuf keeps a reference on the string
+    return gtk.gdk.pixbuf_new_from_data(img.tostring(),
+                                        gtk.gdk.COLORSPACE_RGB, has_alpha, 8,
+                                        width, height,
+                                        width * len(img.mode))
 
 def dummy_progress_cb(progression, total, step=None, doc=None):
     """